@@ -0,0 +1,80 @@
+INFINITY = float("inf")
+
+
+class Alignment(object):
+    """Compare what the student plays with what the teacher played.
+
+    The teacher phrase is a list of (tick, note). Student notes are added
+    one at a time, as they are played, and we keep a running edit distance
+    between the two sequences. Each edit (a wrong note, a missing note,
+    an extra note, or a note played too early or too late) costs 1.
+
+    A note matches if it's the same note, and if it's played within
+    `tolerance` ticks of the teacher's note. Ticks are relative to the
+    first note of each sequence, so the student doesn't have to start
+    at exactly the same time as the teacher.
+
+    We only compute the cells of the alignment matrix that are within
+    `band` notes of the diagonal; so each new student note costs O(band),
+    regardless of the length of the phrase. Alignments straying further
+    than that from the diagonal would exceed any reasonable error budget
+    anyway.
+    """
+
+    def __init__(self, phrase, tolerance=12, errors=1, band=4):
+        self.phrase = [(tick - phrase[0][0], note) for tick, note in phrase]
+        self.tolerance = tolerance  # in ticks
+        self.errors = errors        # how many edits we forgive (grace notes...)
+        self.band = band
+        self.count = 0              # number of student notes so far
+        self.first_tick = None      # tick of the first student note
+        # Cost of aligning the first i notes of the phrase with the
+        # student notes so far (only for i within the band).
+        self.row = {i: i for i in range(min(band, len(self.phrase)) + 1)}
+
+    def cost(self, i, tick, note):
+        # Cost of matching the i-th note of the phrase with a student note
+        teacher_tick, teacher_note = self.phrase[i]
+        if note == teacher_note and abs(tick - teacher_tick) <= self.tolerance:
+            return 0
+        return 1
+
+    def add(self, tick, note):
+        # Add a student note. Return True if it fits the phrase (i.e.
+        # it didn't make the best alignment worse), False otherwise.
+        if self.first_tick is None:
+            self.first_tick = tick
+        tick -= self.first_tick
+        self.count += 1
+        previous = self.row
+        row = {}
+        lowest = max(0, self.count - self.band)
+        highest = min(len(self.phrase), self.count + self.band)
+        for i in range(lowest, highest + 1):
+            row[i] = min(
+                previous.get(i, INFINITY) + 1,  # extra student note
+                row.get(i-1, INFINITY) + 1,     # missed teacher note
+                previous.get(i-1, INFINITY) + self.cost(i-1, tick, note)
+                if i > 0 else INFINITY)
+        self.row = row
+        return min(row.values()) <= min(previous.values())
+
+    @property
+    def score(self):
+        # Number of edits to turn what the student played into the phrase
+        return self.row.get(len(self.phrase), INFINITY)
+
+    @property
+    def perfect(self):
+        return self.score == 0
+
+    @property
+    def passed(self):
+        # Forgive a few errors, but not stopping before the end
+        return (self.count >= len(self.phrase) and
+                self.score <= self.errors)
+
+    @property
+    def failed(self):
+        # Even the best partial alignment has too many errors already
+        return min(self.row.values()) > self.errors
@@ -3,6 +3,7 @@ import logging
 import mido
 
 from gridgets import Gridget, Surface
+from noteoff import NoteOffs
 from palette import palette
 from persistence import persistent_attrs, persistent_attrs_init
 
@@ -98,17 +99,16 @@ class Arpeggiator(object):
         self.next_note = 0  # That's a position in self.notes
         self.direction = 1  # Always 1, except when in BOUNCING mode
         self.latch_notes = set()
-        self.playing = []
+        self.playing = NoteOffs()
         self.next_step = 0  # That's a position in self.pattern
         self.next_tick = 0  # Note: next_tick==0 also means "NOW!"
 
     def tick(self, tick):
         # OK, first, let's see if some notes are currently playing,
-        # but should be stopped.
-        for note, deadline in self.playing:
-            if tick > deadline:
-                self.output(mido.Message("note_on", note=note, velocity=0))
-                self.playing.remove((note, deadline))
+        # but should be stopped. (They stop on the tick *after* their
+        # deadline, hence the -1.)
+        for channel, note, _ in self.playing.expire(tick-1):
+            self.output(mido.Message("note_on", note=note, velocity=0))
 
         # If we're disabled, stop right there
         if not self.enabled:
@@ -173,7 +173,7 @@ class Arpeggiator(object):
             logging.debug("playing note={} velo={} duration={}"
                           .format(note, velocity, duration))
             self.output(mido.Message("note_on", note=note, velocity=velocity))
-            self.playing.append((note, tick+duration))
+            self.playing.add(tick+duration, self.devicechain.channel, note)
 
         # Cycle to the next position in the notes buffer.
         self.next_note += self.direction
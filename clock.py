@@ -1,5 +1,10 @@
+import collections
+import heapq
+import itertools
 import logging
+import os
 import resource
+import threading
 import time
 
 
@@ -17,6 +22,52 @@ NUMBERS = """
 """.strip().split("\n")
 
 
+class Cue(object):
+    # A handle on something that was scheduled with Clock.cue().
+    # Cancelling a cue just flags it; the scheduler discards it
+    # when it reaches the top of the heap.
+
+    def __init__(self, tick, func, args):
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        return ("Cue(tick={}, func={}, cancelled={})"
+                .format(self.tick, self.func, self.cancelled))
+
+
+class Scheduler(object):
+    # A priority queue of cues, ordered by tick.
+    # Cues scheduled for the same tick run in the order they were added.
+
+    def __init__(self):
+        self.heap = []  # (tick, sequence_number, Cue)
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, tick, func, args):
+        cue = Cue(tick, func, args)
+        heapq.heappush(self.heap, (tick, next(self.counter), cue))
+        return cue
+
+    def run(self, tick):
+        # Cues added by a callback (even for the current tick) are
+        # picked up by this same loop, since we re-check the heap
+        # after each callback.
+        heap = self.heap
+        while heap and heap[0][0] <= tick:
+            cue = heapq.heappop(heap)[2]
+            if not cue.cancelled:
+                cue.func(*cue.args)
+
+
 @persistent_attrs(bpm=120)
 class Clock(object):
 
@@ -24,52 +75,214 @@ class Clock(object):
         self.griode = griode
         persistent_attrs_init(self)
         self.tick = 0  # 24 ticks per quarter note
-        self.next = time.time()
-        self.cues = []
+        # All timestamps are in nanoseconds, on the monotonic clock.
+        # (The wall clock can be adjusted by NTP while we're running.)
+        self.next = time.perf_counter_ns()
+        self.due = self.next  # when the tick being rendered should be heard
+        self.cues = Scheduler()
+        self.lookahead = griode.synth.lookahead
+        # Input events (e.g. MIDI messages from rtmidi callbacks) are
+        # posted here by other threads, and processed by the clock thread.
+        # That way, all the state (loops, arpeggiators, gridgets...) is
+        # only ever touched by a single thread.
+        self.inbox = collections.deque()  # (timestamp, func, args)
+        self.incoming = threading.Event()
+        self.notify = self.incoming.set  # how to wake up the clock thread
+        self.input_time = self.next  # timestamp of the event being processed
+        # How long (in ns) we busy-wait before each tick, instead of
+        # sleeping, to avoid oversleeping. 0 = always sleep.
+        self.spin = int(float(os.environ.get("GRIODE_CLOCK_SPIN", "0")) * 1e6)
+        # Timing of each tick (lateness, and time spent in each stage).
+        self.stats = Stats()
 
+    # Schedule func(*args) to run `when` ticks from now.
+    # Returns a Cue object, which can be cancelled.
     def cue(self, when, func, args):
-        self.cues.append((self.tick+when, func, args))
+        return self.cues.add(self.tick+when, func, args)
+
+    # This can be called from any thread. The function will be called
+    # by the clock thread as soon as possible.
+    # (deque.append and deque.popleft are thread-safe and don't block.)
+    def post(self, func, *args):
+        self.inbox.append((time.perf_counter_ns(), func, args))
+        self.notify()
+
+    def drain(self):
+        # The messages generated by the input events are handed over
+        # to the synth's sender thread all at once, when we're done.
+        inbox = self.inbox
+        with self.lookahead.batch():
+            while inbox:
+                self.input_time, func, args = inbox.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    logging.exception("Error while processing {}{}"
+                                      .format(func, args))
 
     def callback(self):
-        expired_cues = [cue for cue in self.cues if cue[0] <= self.tick]
-        for when, func, args in expired_cues:
-            func(*args)
-        for cue in expired_cues:
-            self.cues.remove(cue)
-        for devicechain in self.griode.devicechains:
-            devicechain.arpeggiator.tick(self.tick)
-        for grid in self.griode.grids:
-            grid.tick(self.tick)
-        for grid in self.griode.grids:
-            grid.loopcontroller.tick(self.tick)
-        self.griode.looper.tick(self.tick)
-        self.griode.cpu.tick(self.tick)
-        self.griode.tick(self.tick)
-
-    # Return how long it is until the next tick.
+        # Each stage is timed separately, so that when we're running
+        # late, we can tell who's responsible. (See Stats below.)
+        now = time.perf_counter_ns
+        add = self.stats.add
+        tin = now()
+        self.drain()
+        t0 = now()
+        add("input", t0-tin)
+        # Notes generated during the tick will be heard at self.due,
+        # even if we run ahead of time. (See lookahead.py.)
+        with self.lookahead.rendering(self.due):
+            self.cues.run(self.tick)
+            t1 = now()
+            for devicechain in self.griode.devicechains:
+                devicechain.arpeggiator.tick(self.tick)
+            t2 = now()
+            for grid in self.griode.grids:
+                grid.tick(self.tick)
+            t3 = now()
+            for grid in self.griode.grids:
+                grid.loopcontroller.tick(self.tick)
+            t4 = now()
+            self.griode.looper.tick(self.tick)
+            t5 = now()
+            self.griode.cpu.tick(self.tick)
+            t6 = now()
+            self.griode.tick(self.tick)
+        add("cues", t1-t0)
+        add("arpeggiators", t2-t1)
+        add("grids", t3-t2)
+        add("loopcontrollers", t4-t3)
+        add("looper", t5-t4)
+        add("cpu", t6-t5)
+        add("total", now()-t0)
+
+    # Return how many ticks (with a fractional part) separate a timestamp
+    # (e.g. self.input_time) from the time when `tick` is due.
+    # It's negative if the timestamp is before that time.
+    def ticks_from(self, timestamp, tick):
+        due = self.due + (tick - self.tick) * self.tick_ns
+        return (timestamp - due) / self.tick_ns
+
+    # Duration of a tick (in ns) at the current tempo.
+    @property
+    def tick_ns(self):
+        return round(60e9 / self.bpm / 24)
+
+    # When the next tick should be computed. That's when it is due,
+    # minus the lookahead window (if any).
+    @property
+    def wakeup(self):
+        return self.next - self.lookahead.window
+
+    # Return how long it is until the next tick, in seconds.
     # (Or zero if the next tick is due now, or overdue.)
     def poll(self):
-        now = time.time()
-        if now < self.next:
-            return self.next - now
+        now = time.perf_counter_ns()
+        if now < self.wakeup:
+            return (self.wakeup - now) / 1e9
+        self.stats.add("lateness", now - self.wakeup)
         self.tick += 1
+        self.due = self.next
         self.callback()
         # Compute when we're due next
-        self.next += 60.0 / self.bpm / 24
-        if now > self.next:
+        self.next += self.tick_ns
+        if now > self.wakeup:
             logging.warning("We're running late by {} seconds!"
-                            .format(self.next-now))
+                            .format((self.wakeup-now) / 1e9))
             # If we are late, should we try to stay aligned, or skip?
-            margin = 0.0  # Put 1.0 for pseudo-realtime
-            if now > self.next + margin:
+            margin = 0  # Put 1e9 for pseudo-realtime
+            if now > self.wakeup + margin:
                 logging.warning("Catching up (deciding that next tick = now).")
-                self.next = now
+                self.next = now + self.lookahead.window
             return 0
-        return self.next - now
+        return (self.wakeup - now) / 1e9
 
-    # Wait until next tick is due.
+    # Wait until next tick is due, or until some input is posted.
+    # We sleep most of the time, then spin for the last few moments
+    # (if GRIODE_CLOCK_SPIN is set), because sleep() can overshoot
+    # by a few ms on a busy system, and a tick is only ~12ms at 200 BPM.
+    # (The asyncio runtime in griode.py does the same thing, with the
+    # same building blocks: poll, timeout, drain, spin_until_wakeup.)
     def once(self):
-        time.sleep(self.poll())
+        delay = self.poll()
+        if delay == 0:
+            return
+        timeout = self.timeout(delay)
+        if timeout is not None and self.incoming.wait(timeout):
+            self.incoming.clear()
+            self.drain()
+            return
+        self.spin_until_wakeup()
+
+    # How long we can wait for input, given the delay returned by poll().
+    # That's the delay minus the time we spin; None means "don't wait".
+    def timeout(self, delay):
+        if delay > self.spin / 1e9:
+            return delay - self.spin / 1e9
+        return None
+
+    def spin_until_wakeup(self):
+        while time.perf_counter_ns() < self.wakeup:
+            pass
+
+    # Ask the OS to run the clock thread, and the thread sending messages
+    # to the synth, with realtime priority. This should be called from the
+    # clock thread. It requires appropriate privileges (e.g. CAP_SYS_NICE
+    # or rtprio in limits.conf). Threads started afterwards by the clock
+    # thread don't inherit that priority (that's SCHED_RESET_ON_FORK).
+    def realtime(self, priority):
+        for name, thread_id in [
+            ("clock", 0),  # 0 = the calling thread
+            ("sender", self.lookahead.thread.native_id),
+        ]:
+            try:
+                os.sched_setscheduler(
+                    thread_id, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK,
+                    os.sched_param(priority))
+                logging.info("{} thread running with SCHED_FIFO priority {}"
+                             .format(name.capitalize(), priority))
+            except (AttributeError, OSError):
+                logging.exception("Could not switch {} thread to realtime "
+                                  "priority".format(name))
+
+##############################################################################
+
+class Stats(object):
+    # Keep the last few timing samples (in ns) for a bunch of named stages,
+    # so that we can show percentiles. Adding a sample is cheap (it's
+    # just a deque append), so this can stay enabled all the time; the
+    # sorting only happens when we dump the stats.
+    # (Send SIGUSR1 to griode to dump them in the logs.)
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.samples = collections.OrderedDict()
+
+    def add(self, stage, ns):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = collections.deque(maxlen=self.size)
+            self.samples[stage] = samples
+        samples.append(ns)
+
+    def report(self):
+        # Return {stage: (p50, p99, max)} with values in ms.
+        report = collections.OrderedDict()
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            if not samples:
+                continue
+            p50 = samples[len(samples)*50//100]
+            p99 = samples[len(samples)*99//100]
+            report[stage] = (p50/1e6, p99/1e6, samples[-1]/1e6)
+        return report
+
+    def dump(self):
+        logging.info("Timing stats over the last {} ticks (in ms):"
+                     .format(self.size))
+        for stage, (p50, p99, max_) in self.report().items():
+            logging.info("{:>16}: p50={:7.3f} p99={:7.3f} max={:7.3f}"
+                         .format(stage, p50, p99, max_))
 
 ##############################################################################
 
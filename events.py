@@ -0,0 +1,228 @@
+import array
+import bisect
+import collections
+import struct
+import sys
+
+
+Event = collections.namedtuple(
+    "Event", "tick note velocity duration offset", defaults=(0, ))
+
+# Notes can start a fraction of tick after their tick (e.g. when they are
+# recorded live). That offset is stored in 1/SUBTICKS of a tick; with
+# 24 ticks per quarter note, that's 960 PPQN.
+SUBTICKS = 40
+
+
+class Occupancy(object):
+    """Which cells of a loop have notes, for a given cell size.
+
+    The loop editors show the loop as a grid of cells, each cell
+    covering `ticks_per_cell` ticks. To draw them, they need to know,
+    for each cell, if notes start on its first tick, on its other
+    ticks, and which notes start on its first tick. We keep counts
+    (rather than booleans) so that removing a note is easy.
+    """
+
+    def __init__(self, ticks_per_cell):
+        self.ticks_per_cell = ticks_per_cell
+        self.first = collections.Counter()  # cell -> number of notes
+        self.other = collections.Counter()  # cell -> number of notes
+        self.notes = collections.Counter()  # (cell, note) -> number of notes
+
+    def update(self, tick, note, delta):
+        cell, offset = divmod(tick, self.ticks_per_cell)
+        if offset == 0:
+            self.first[cell] += delta
+            self.notes[cell, note] += delta
+        else:
+            self.other[cell] += delta
+
+    def has_first(self, cell):
+        return self.first[cell] > 0
+
+    def has_other(self, cell):
+        return self.other[cell] > 0
+
+    def has_note(self, cell, note):
+        return self.notes[cell, note] > 0
+
+
+class Events(object):
+    """The notes of a loop, stored in compact arrays.
+
+    Each note is stored in five parallel arrays (start tick, note number,
+    velocity, duration, sub-tick offset), kept sorted by start tick.
+    That's about 11 bytes per note, instead of a Python object per note, and it can be saved
+    and loaded with a few memcpy.
+
+    Notes with the same start tick are kept in the order they were added.
+
+    The `version` number is incremented before and after each change.
+    (It's odd while a change is in progress.) This lets other threads
+    (e.g. the one saving the state) detect that the arrays changed
+    while they were reading them. It also lets playback cursors know
+    when they need to re-synchronize.
+    """
+
+    MAGIC = b"GEV2"
+    MAGIC_V1 = b"GEV1"  # same thing, but without the offsets column
+
+    def __init__(self):
+        self.ticks = array.array("I")
+        self.notes = array.array("B")
+        self.velocities = array.array("B")
+        self.durations = array.array("I")
+        self.offsets = array.array("B")
+        self.version = 0
+        self.occupancies = {}  # ticks_per_cell -> Occupancy
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __bool__(self):
+        return len(self.ticks) > 0
+
+    def __contains__(self, tick):
+        # Is there at least one note starting at that tick?
+        i = bisect.bisect_left(self.ticks, tick)
+        return i < len(self.ticks) and self.ticks[i] == tick
+
+    def __iter__(self):
+        for i in range(len(self.ticks)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        return Event(self.ticks[i], self.notes[i], self.velocities[i],
+                     self.durations[i], self.offsets[i])
+
+    def __repr__(self):
+        return "Events({})".format(list(self))
+
+    def span(self, tick_from, tick_to):
+        # Return the range of indexes of notes starting in [tick_from, tick_to[
+        return range(bisect.bisect_left(self.ticks, tick_from),
+                     bisect.bisect_left(self.ticks, tick_to))
+
+    def at(self, tick):
+        # Return the notes starting at a given tick.
+        return [self[i] for i in self.span(tick, tick+1)]
+
+    def between(self, tick_from, tick_to):
+        # Return the notes starting in [tick_from, tick_to[
+        return [self[i] for i in self.span(tick_from, tick_to)]
+
+    def cells(self, ticks_per_cell):
+        # Return the Occupancy for that cell size. It's computed the first
+        # time, then kept up to date as notes are added and removed.
+        occupancy = self.occupancies.get(ticks_per_cell)
+        if occupancy is None:
+            occupancy = Occupancy(ticks_per_cell)
+            for tick, note in zip(self.ticks, self.notes):
+                occupancy.update(tick, note, 1)
+            self.occupancies[ticks_per_cell] = occupancy
+        return occupancy
+
+    def add(self, tick, note, velocity, duration, offset=0):
+        i = bisect.bisect_right(self.ticks, tick)
+        self.version += 1
+        self.ticks.insert(i, tick)
+        self.notes.insert(i, note)
+        self.velocities.insert(i, velocity)
+        self.durations.insert(i, duration)
+        self.offsets.insert(i, offset)
+        self.version += 1
+        for occupancy in self.occupancies.values():
+            occupancy.update(tick, note, 1)
+        return i
+
+    def remove(self, tick, note):
+        # Remove the first note with that number starting at that tick.
+        # Return True if a note was removed.
+        for i in self.span(tick, tick+1):
+            if self.notes[i] == note:
+                self.version += 1
+                del self.ticks[i]
+                del self.notes[i]
+                del self.velocities[i]
+                del self.durations[i]
+                del self.offsets[i]
+                self.version += 1
+                for occupancy in self.occupancies.values():
+                    occupancy.update(tick, note, -1)
+                return True
+        return False
+
+    def set_duration(self, tick, note, duration):
+        # Set the duration of a note that was recorded with duration 0.
+        for i in self.span(tick, tick+1):
+            if self.notes[i] == note and self.durations[i] == 0:
+                self.version += 1
+                self.durations[i] = duration
+                self.version += 1
+                return True
+        return False
+
+    def clear(self):
+        self.version += 1
+        for column in self.columns():
+            del column[:]
+        self.version += 1
+        self.occupancies.clear()
+
+    def columns(self):
+        return [self.ticks, self.notes, self.velocities, self.durations,
+                self.offsets]
+
+    # Binary serialization format:
+    # magic (4 bytes), number of notes (uint32), then each column in
+    # order (ticks, notes, velocities, durations, offsets), little-endian.
+    # The first version of the format (GEV1) didn't have offsets.
+
+    def to_bytes(self):
+        version = self.version
+        if version % 2:
+            raise RuntimeError("Events changed while serializing")
+        data = [self.MAGIC, struct.pack("<I", len(self.ticks))]
+        for column in self.columns():
+            if sys.byteorder == "big":
+                column = array.array(column.typecode, column)
+                column.byteswap()
+            data.append(column.tobytes())
+        if self.version != version:
+            raise RuntimeError("Events changed while serializing")
+        return b"".join(data)
+
+    @classmethod
+    def from_bytes(klass, data):
+        events = klass()
+        columns = events.columns()
+        if data[:4] == klass.MAGIC_V1:
+            columns = columns[:4]
+        elif data[:4] != klass.MAGIC:
+            raise ValueError("Invalid events data")
+        count, = struct.unpack("<I", data[4:8])
+        offset = 8
+        for column in columns:
+            size = count * column.itemsize
+            column.frombytes(data[offset:offset+size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            offset += size
+        if len(columns) < len(events.columns()):
+            events.offsets.frombytes(bytes(len(events.ticks)))
+        if len(set(len(column) for column in events.columns())) != 1:
+            raise ValueError("Truncated events data")
+        return events
+
+    def __reduce__(self):
+        return (self.__class__.from_bytes, (self.to_bytes(), ))
+
+    @classmethod
+    def from_dict(klass, notes):
+        # Convert the old format ({tick: [Note, ...]}) to Events.
+        events = klass()
+        for tick in sorted(notes):
+            for note in notes[tick]:
+                events.add(tick, note.note, note.velocity, note.duration)
+        return events
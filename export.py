@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import mido
+import os
+import pickle
+import subprocess
+import tempfile
+
+from events import SUBTICKS
+from fluidsynth import (build_fonts, find_instrument, find_soundfonts,
+                        load_commands, load_instruments)
+import persistence
+
+# Syntax: export [options] <output.mid> [<row>,<col>...]
+# Export loops (by default, all the loops that have notes) to a Standard
+# MIDI File, with one track per loop. Each loop is repeated until the end
+# of the longest loop (or for the number of bars given with --bars).
+# With --wav, also render that file to audio, using the same soundfonts
+# as Griode (with fluidsynth's file renderer; much faster than realtime).
+
+parser = argparse.ArgumentParser(description="Export loops to MIDI or WAV.")
+parser.add_argument("output", help="MIDI file to write")
+parser.add_argument("cells", nargs="*", metavar="row,col",
+                    help="loops to export (default = all non-empty loops)")
+parser.add_argument("-b", "--bars", type=int,
+                    help="length of the export (default = longest loop)")
+parser.add_argument("-w", "--wav", help="also render to that WAV file")
+
+
+def saved(class_name, id_str, attr_name, default_value):
+    # Read a persistent attribute from the state store, without having to
+    # instantiate the whole object (and the whole Griode) around it.
+    if id_str is None:
+        filename = "state/{}.sav".format(class_name)
+    else:
+        filename = "state/{}__{}.sav".format(class_name, id_str)
+    data = persistence.get_store().load(filename)
+    if attr_name in data:
+        return pickle.loads(data[attr_name])
+    return default_value
+
+
+def loop_length(loop, notes):
+    # Length of a loop, in ticks; or None if it's empty.
+    if loop.tick_out > 0:
+        return loop.tick_out - loop.tick_in
+    if notes:
+        return max(note.tick + max(note.duration, 1) for note in notes)
+    return None
+
+
+def loop_messages(loop, notes, length):
+    # Return (time, message) for the notes of a loop, repeated (if it
+    # loops) until `length` ticks. Times are in 1/SUBTICKS of a tick.
+    messages = []
+    if loop.tick_out > 0:
+        notes = notes.between(loop.tick_in, loop.tick_out)
+        starts = range(0, length, loop.tick_out - loop.tick_in)
+    else:
+        notes = list(notes)
+        starts = [0]
+    for start in starts:
+        for note in notes:
+            tick = start + note.tick - loop.tick_in
+            if tick >= length:
+                break
+            stop = min(tick + max(note.duration, 1), length)
+            messages.append((tick*SUBTICKS + note.offset, mido.Message(
+                "note_on", channel=loop.channel,
+                note=note.note, velocity=note.velocity)))
+            messages.append((stop*SUBTICKS, mido.Message(
+                "note_off", channel=loop.channel, note=note.note)))
+    # At the same time, stop notes before starting new ones
+    messages.sort(key=lambda m: (m[0], m[1].type == "note_on"))
+    return messages
+
+
+def to_track(name, messages):
+    # Convert (absolute time, message) to a MIDI track (with delta times)
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage("track_name", name=name, time=0))
+    now = 0
+    for time, message in messages:
+        track.append(message.copy(time=time-now))
+        now = time
+    return track
+
+
+def render(midi_filename, wav_filename, soundfonts):
+    # Same soundfonts, same bank offsets, same bank select mode as
+    # the live synth (see fluidsynth.py), so it sounds the same.
+    with tempfile.NamedTemporaryFile("w", suffix=".fluidsynth") as commands:
+        commands.write(load_commands(soundfonts))
+        commands.flush()
+        subprocess.check_call([
+            "fluidsynth", "-n", "-i",
+            "-o", "synth.midi-bank-select=mma",
+            "-o", "synth.sample-rate=44100",
+            "-f", commands.name, "-F", wav_filename, midi_filename,
+        ])
+
+
+def main():
+    from looper import Loop, Looper
+    args = parser.parse_args()
+
+    if args.cells:
+        cells = [tuple(int(x) for x in cell.split(",")) for cell in args.cells]
+    else:
+        cells = [(row, column) for row in range(1, 9) for column in range(1, 9)]
+    loops = [Loop(looper=None, cell=cell) for cell in cells]
+    loops = [loop for loop in loops
+             if loop.channel is not None and loop.notes]
+    if not loops:
+        parser.error("No loop to export")
+
+    # Export the notes as they would be played (i.e. quantized, for
+    # loops that are quantized on playback).
+    settings = tuple(
+        saved("Looper", None, name, getattr(Looper, name).default_value)
+        for name in ("quantize_grid", "quantize_strength",
+                     "quantize_swing", "quantize_humanize"))
+    notes = {loop: loop.playback(settings) for loop in loops}
+
+    beats_per_bar = saved("Looper", None, "beats_per_bar", 4)
+    if args.bars:
+        length = args.bars * beats_per_bar * 24
+    else:
+        length = max(loop_length(loop, notes[loop]) for loop in loops)
+
+    # We need the list of instruments to know which program (and bank)
+    # each channel uses. We don't need an audio output for that.
+    soundfonts = find_soundfonts()
+    instruments = load_instruments(
+        ["fluidsynth", "-n", "-a", "file", "-o", "audio.file.name=/dev/null",
+         "-o", "synth.midi-bank-select=mma"], soundfonts)
+    fonts = build_fonts(instruments)
+
+    # 24 ticks per quarter note, each divided in SUBTICKS
+    midi_file = mido.MidiFile(type=1, ticks_per_beat=24*SUBTICKS)
+    bpm = saved("Clock", None, "bpm", 120)
+    midi_file.tracks.append(to_track("griode", [
+        (0, mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(bpm))),
+        (0, mido.MetaMessage("time_signature",
+                             numerator=beats_per_bar, denominator=4)),
+    ]))
+    for loop in loops:
+        instrument = find_instrument(fonts, *[
+            saved("DeviceChain", str(loop.channel), attr_name, 0)
+            for attr_name in ("font_index", "group_index",
+                              "instr_index", "bank_index")])
+        logging.info("Exporting {} (channel {}, {})"
+                     .format(loop, loop.channel, instrument.name))
+        messages = [(0, message.copy(channel=loop.channel))
+                    for message in instrument.messages()]
+        messages.extend(loop_messages(loop, notes[loop], length))
+        midi_file.tracks.append(to_track(
+            "{},{}".format(*loop.cell), messages))
+    midi_file.save(args.output)
+    logging.info("Saved {} tracks ({} ticks) to {}"
+                 .format(len(loops), length, args.output))
+
+    if args.wav:
+        render(args.output, args.wav, soundfonts)
+        logging.info("Rendered {} to {}".format(args.output, args.wav))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    main()
@@ -1,12 +1,19 @@
 import glob
+import hashlib
 import logging
 import os
 import mido
+import pickle
 import re
+import struct
 import subprocess
 import sys
 import time
 
+from lookahead import Lookahead
+import persistence
+import sf2
+
 # When we start the fluidsynth process, we use "MMA" bank select mode.
 # This is the only mode that allows more than 128 banks (since it uses
 # two control change messages to encode the bank number).
@@ -39,10 +46,129 @@ class Instrument(object):
         return ("Instrument({0.font}, {0.program}, {0.bank}, {0.name})"
                 .format(self))
 
+def find_soundfonts():
+    return sorted(glob.glob("soundfonts/?.sf2"))
+
+
+def load_commands(soundfonts):
+    # Fluidsynth shell commands to load the soundfonts. Each soundfont
+    # gets a bank offset of 1000, so that their banks don't overlap.
+    msg = ""
+    for i, soundfont in enumerate(soundfonts):
+        offset = i*1000
+        msg += "load {} 1 {}\n".format(soundfont, offset)
+    return msg
+
+
+def enumerate_instruments(popen_args, soundfonts):
+    # Invoke fluidsynth, and ask it the list of instruments
+    # in each soundfont. Return a list of Instrument objects.
+    logging.debug("Invoking fluidsynth to enumerate instruments...")
+    fluidsynth = subprocess.Popen(
+        popen_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    msg = load_commands(soundfonts)
+    for i, soundfont in enumerate(soundfonts):
+        font_id = i+1
+        msg += "inst {}\n".format(font_id)
+    fluidsynth.stdin.write(msg.encode("ascii"))
+    fluidsynth.stdin.flush()
+    fluidsynth.stdin.close()
+    output = fluidsynth.stdout.read().decode("ascii")
+    fluidsynth.wait()
+    instruments = []
+    for bank, prog, name in re.findall("\n([0-9]{3,})-([0-9]{3}) (.*)", output):
+        bank = int(bank)
+        prog = int(prog)
+        font_id = bank // 1000
+        instrument = Instrument(font_id, prog, bank, name)
+        instruments.append(instrument)
+    logging.info("Found {} instruments".format(len(instruments)))
+    return instruments
+
+
+def read_instruments(soundfonts):
+    # Read the list of instruments directly from the soundfonts.
+    # This gives the same result as enumerate_instruments (same bank
+    # offsets, same order) without starting fluidsynth.
+    instruments = []
+    for i, soundfont in enumerate(soundfonts):
+        offset = i*1000
+        seen = set()
+        for bank, prog, name in sorted(sf2.presets(soundfont)):
+            if (bank, prog) in seen:
+                continue  # fluidsynth only exposes the first one
+            seen.add((bank, prog))
+            bank += offset
+            font_id = bank // 1000
+            instruments.append(Instrument(font_id, prog, bank, name))
+    logging.info("Found {} instruments".format(len(instruments)))
+    return instruments
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_instruments(popen_args, soundfonts):
+    # Read the instruments from the soundfonts if we can; otherwise,
+    # ask fluidsynth.
+    try:
+        return read_instruments(soundfonts)
+    except (OSError, ValueError, struct.error):
+        logging.exception("Could not read soundfonts; asking fluidsynth")
+    return cached_instruments(popen_args, soundfonts)
+
+
+def cached_instruments(popen_args, soundfonts):
+    # Enumerating instruments means loading all the soundfonts in
+    # fluidsynth, which takes a while on a Pi. So we keep the list of
+    # instruments in the state store, with the size, mtime, and hash of
+    # each soundfont; and we only enumerate again if a soundfont changed.
+    # (If only the mtime changed, we check the hash before deciding.)
+    store = persistence.get_store()
+    data = store.load("cache/instruments").get("instruments")
+    cache = pickle.loads(data) if data else None
+    if cache and len(cache["soundfonts"]) == len(soundfonts):
+        valid = True
+        signatures = []
+        for (path, size, mtime, digest), soundfont in zip(
+                cache["soundfonts"], soundfonts):
+            stat = os.stat(soundfont)
+            if path != soundfont or size != stat.st_size:
+                valid = False
+                break
+            if mtime != stat.st_mtime_ns and file_hash(soundfont) != digest:
+                valid = False
+                break
+            signatures.append((path, size, stat.st_mtime_ns, digest))
+        if valid:
+            logging.info("Using cached list of {} instruments"
+                         .format(len(cache["instruments"])))
+            if signatures != cache["soundfonts"]:
+                cache["soundfonts"] = signatures
+                store.save([("cache/instruments", "instruments",
+                             pickle.dumps(cache))])
+            return [Instrument(*args) for args in cache["instruments"]]
+    instruments = enumerate_instruments(popen_args, soundfonts)
+    cache = dict(
+        soundfonts=[(soundfont, os.stat(soundfont).st_size,
+                     os.stat(soundfont).st_mtime_ns, file_hash(soundfont))
+                    for soundfont in soundfonts],
+        instruments=[(i.font, i.program, i.bank, i.name)
+                     for i in instruments],
+    )
+    store.save([("cache/instruments", "instruments", pickle.dumps(cache))])
+    return instruments
+
+
 class Fluidsynth(object):
 
     def __init__(self):
-        soundfonts = sorted(glob.glob("soundfonts/?.sf2"))
+        soundfonts = find_soundfonts()
 
         # Pre-flight check
         if not soundfonts:
@@ -75,50 +201,55 @@ class Fluidsynth(object):
             exit(1)
         logging.info("Using audio driver: {}".format(audio_driver))
 
+        # Audio buffers: number of periods, and size of each period (in
+        # samples). Smaller buffers mean less latency, but more risk of
+        # underruns (crackles).
+        periods = int(os.environ.get("GRIODE_AUDIO_PERIODS", "8"))
+        period_size = os.environ.get("GRIODE_AUDIO_PERIOD_SIZE")
+        if period_size is not None:
+            period_size = int(period_size)
+
         popen_args = [
             "fluidsynth", "-a", audio_driver,
             "-o", "synth.midi-bank-select=mma",
             "-o", "synth.sample-rate=44100",
-            "-c", "8", "-p", "griode"
+            "-c", str(periods), "-p", "griode"
         ]
+        if period_size is not None:
+            popen_args += ["-z", str(period_size)]
 
-        # Invoke fluidsynth a first time to enumerate instruments
-        logging.debug("Invoking fluidsynth to enumerate instruments...")
-        self.fluidsynth = subprocess.Popen(
-            popen_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        msg = ""
-        for i, soundfont in enumerate(soundfonts):
-            font_id = i+1
-            offset = i*1000
-            msg += "load {} 1 {}\n".format(soundfont, offset)
-            msg += "inst {}\n".format(font_id)
-        self.fluidsynth.stdin.write(msg.encode("ascii"))
-        self.fluidsynth.stdin.flush()
-        self.fluidsynth.stdin.close()
-        output = self.fluidsynth.stdout.read().decode("ascii")
-        instruments = re.findall("\n([0-9]{3,})-([0-9]{3}) (.*)", output)
-        self.instruments = []
-        for bank, prog, name in instruments:
-            bank = int(bank)
-            prog = int(prog)
-            font_id = bank // 1000
-            instrument = Instrument(font_id, prog, bank, name)
-            self.instruments.append(instrument)
-        logging.info("Found {} instruments".format(len(self.instruments)))
-
+        # Find out which instruments are available
+        self.instruments = load_instruments(popen_args, soundfonts)
         self.fonts = build_fonts(self.instruments)
+        sort_instruments(self.instruments)
+
+        # And now, start the actual synth. By default, it's a fluidsynth
+        # process, and we talk to it over MIDI. With GRIODE_SYNTH=lib, we
+        # load libfluidsynth in our process instead, and call it directly.
+        if os.environ.get("GRIODE_SYNTH") == "lib":
+            from libfluidsynth import LibFluidsynth
+            try:
+                self.lib = LibFluidsynth(
+                    audio_driver, soundfonts, period_size, periods)
+            except OSError:
+                logging.exception("Could not start libfluidsynth")
+                exit(1)
+            output = self.lib.send
+        else:
+            output = self.start_process(popen_args, soundfonts)
 
-        # Re-order the instruments list
-        # (This is used to cycle through instruments in order)
-        def get_instrument_order(i):
-            return (i.font_index, i.program, i.bank_index)
-        self.instruments.sort(key=get_instrument_order)
+        # Optionally, render notes ahead of time (see lookahead.py).
+        # GRIODE_LOOKAHEAD is in milliseconds.
+        window = float(os.environ.get("GRIODE_LOOKAHEAD", "0"))
+        self.lookahead = Lookahead(output, int(window * 1e6))
 
-        # And now, restart fluidsynth but for actual synth use
+    def start_process(self, popen_args, soundfonts):
+        # Start fluidsynth, connect to its MIDI port, and return
+        # the function to call to send it messages.
         logging.debug("Starting fluidsynth as a synthesizer...")
         self.fluidsynth = subprocess.Popen(
             popen_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        self.fluidsynth.stdin.write(msg.encode("ascii"))
+        self.fluidsynth.stdin.write(load_commands(soundfonts).encode("ascii"))
         self.fluidsynth.stdin.flush()
 
         # Find the MIDI port created by fluidsynth and open it
@@ -138,9 +269,28 @@ class Fluidsynth(object):
         else:
             logging.error("Failed to locate the fluidsynth port!")
             exit(1)
+        return self.synth_port.send
 
     def send(self, message):
-        self.synth_port.send(message)
+        self.lookahead.send(message)
+
+
+def sort_instruments(instruments):
+    # Re-order the instruments list
+    # (This is used to cycle through instruments in order)
+    def get_instrument_order(i):
+        return (i.font_index, i.program, i.bank_index)
+    instruments.sort(key=get_instrument_order)
+
+
+def find_instrument(fonts, font_index, group_index, instr_index, bank_index):
+    # Return the instrument at these indexes (they are UI values; see
+    # build_fonts below). If that instrument does not exist, fallback
+    # to an (existing) one.
+    groups = fonts.get(font_index, fonts[0])
+    instrs = groups.get(group_index, groups[0])
+    banks = instrs.get(instr_index, instrs[0])
+    return banks.get(bank_index, banks[0])
 
 
 def classify(list_of_things, get_key):
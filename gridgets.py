@@ -18,6 +18,8 @@ class Surface(object):
         self.leds = {}
         for led in parent:
             self.leds[led] = palette.BLACK
+        # Incremented each time a led changes color
+        self.version = 0
         # Setup the masked surface
         # (By default, it filters out all display)
         self.parent = MaskedSurface(parent)
@@ -28,6 +30,11 @@ class Surface(object):
     def __getitem__(self, led):
         return self.leds[led]
 
+    @property
+    def visible(self):
+        # Is at least one of our leds currently shown on the grid?
+        return bool(self.parent.mask)
+
     def __setitem__(self, led, color):
         if led not in self.leds:
             logging.error("LED {} does not exist!".format(led))
@@ -35,6 +42,7 @@ class Surface(object):
             current_color = self.leds[led]
             if color != current_color:
                 self.leds[led] = color
+                self.version += 1
                 if self.parent:
                     self.parent[led] = color
 
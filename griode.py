@@ -1,20 +1,23 @@
 #!/usr/bin/env python3
+import asyncio
 import logging
 import mido
 import os
-import time
+import signal
 
 
 from arpeggiator import ArpConfig, Arpeggiator
 from clock import BPMSetter, Clock, CPU
-from fluidsynth import Fluidsynth
+from fluidsynth import Fluidsynth, find_instrument
 from latch import Latch, LatchConfig
 from looper import Looper, LoopController
 from gridgets import MENU, Menu
+from hotplug import Scanner, device_class
 from mixer import Faders, Mixer
 import notes
 from palette import palette
-from persistence import cache, persistent_attrs, persistent_attrs_init
+import persistence
+from persistence import persistent_attrs, persistent_attrs_init
 from pickers import ColorPicker, InstrumentPicker, NotePicker, ScalePicker
 import scales
 
@@ -45,9 +48,7 @@ class Griode(object):
     def tick(self, tick):
         pass
 
-    def detect_devices(self, initial=True):
-        from launchpad import LaunchpadMK2, LaunchpadPro, LaunchpadS
-        from keyboard import Keyboard
+    def detect_devices(self):
         logging.debug("Enumerating MIDI ports...")
         configured_ports = { grid.grid_name for grid in self.grids }
         try:
@@ -57,28 +58,18 @@ class Griode(object):
             detected_ports = set()
         for port_name in detected_ports - configured_ports:
             # Detected a new device! Yay!
-            klass = None
-            if "Launchpad Pro MIDI 2" in port_name:
-                klass = LaunchpadPro
-            if "Launchpad MK2" in port_name:
-                klass = LaunchpadMK2
-            if "Launchpad S" in port_name:
-                klass = LaunchpadS
-            if "Launchpad Mini" in port_name:
-                klass = LaunchpadS
-            if "reface" in port_name:
-                klass = Keyboard
+            klass = device_class(port_name)
             if klass is not None:
-                # FIXME find a better way than this for hotplug!
-                if not initial:
-                    logging.info("Detected hotplug of new device: {}".format(port_name))
-                    time.sleep(4)
-                self.grids.append(klass(self, port_name))
+                grid = klass(self, port_name)
+                self.grids.append(grid)
+                grid.start()
         for port_name in configured_ports - detected_ports:
-            # Removing a device
-            logging.info("Device {} is no longer plugged. Removing it."
-                         .format(port_name))
-            self.grids = [g for g in self.grids if g.grid_name != port_name]
+            self.remove_device(port_name)
+
+    def remove_device(self, port_name):
+        logging.info("Device {} is no longer plugged. Removing it."
+                     .format(port_name))
+        self.grids = [g for g in self.grids if g.grid_name != port_name]
 
 ##############################################################################
 
@@ -119,6 +110,11 @@ class Grid(object):
             # Draw it
             self.surface[led] = gridget.surface[led]
 
+    # Called in the clock thread, once the grid is part of griode.grids.
+    # Grids that receive input from a device start processing it here.
+    def start(self):
+        pass
+
     def tick(self, tick):
         pass
 
@@ -140,12 +136,9 @@ class DeviceChain(object):
     # `instrument` property below will fallback to an (existing) one.
     @property
     def instrument(self):
-        fonts = self.griode.synth.fonts
-        groups = fonts.get(self.font_index, fonts[0])
-        instrs = groups.get(self.group_index, groups[0])
-        banks = instrs.get(self.instr_index, instrs[0])
-        instrument = banks.get(self.bank_index, banks[0])
-        return instrument
+        return find_instrument(self.griode.synth.fonts, self.font_index,
+                               self.group_index, self.instr_index,
+                               self.bank_index)
 
     def program_change(self):
         instrument = self.instrument
@@ -172,15 +165,85 @@ def show_pattern(griode, pattern, color_on, color_off):
                 grid.surface[led] = color_off
 
 
+##############################################################################
+
+# Alternative runtime, where everything runs as tasks on an asyncio loop.
+# Enable it by setting GRIODE_ASYNCIO=1.
+
+async def run_clock(clock):
+    loop = asyncio.get_running_loop()
+    incoming = asyncio.Event()
+    # Input is posted from rtmidi threads; wake up the loop when it happens.
+    clock.notify = lambda: loop.call_soon_threadsafe(incoming.set)
+    # Same as Clock.once(), except that we await input instead of blocking.
+    while True:
+        delay = clock.poll()
+        if delay == 0:
+            await asyncio.sleep(0)
+            continue
+        timeout = clock.timeout(delay)
+        if timeout is not None:
+            try:
+                await asyncio.wait_for(incoming.wait(), timeout)
+                incoming.clear()
+                clock.drain()
+                continue
+            except asyncio.TimeoutError:
+                pass
+        clock.spin_until_wakeup()
+
+
+async def run_hotplug(scanner):
+    # Scan (and open new devices) off the loop; new devices are posted
+    # to the clock, so they're added on the loop thread (see hotplug.py).
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(scanner.interval)
+        try:
+            await loop.run_in_executor(None, scanner.scan)
+        except Exception:
+            logging.exception("Error while scanning MIDI ports")
+
+
+async def run_persistence(interval=2):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, persistence.flush)
+        except Exception:
+            logging.exception("Error while saving state")
+
+
+async def run(griode):
+    await asyncio.gather(
+        run_clock(griode.clock),
+        run_hotplug(Scanner(griode)),
+        run_persistence(),
+    )
+
+
 def main():
     griode = Griode()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: griode.clock.stats.dump())
+    rtprio = int(os.environ.get("GRIODE_RTPRIO", "0"))
     try:
-        while True:
-            griode.clock.once()
+        if os.environ.get("GRIODE_ASYNCIO"):
+            if rtprio:
+                griode.clock.realtime(rtprio)
+            asyncio.run(run(griode))
+        else:
+            # Start the background threads first: only the clock thread
+            # (and the synth's sender thread) should run in realtime.
+            Scanner(griode).start()
+            persistence.start_flusher()
+            if rtprio:
+                griode.clock.realtime(rtprio)
+            while True:
+                griode.clock.once()
     except KeyboardInterrupt:
         show_pattern(griode, PATTERN_SAVING, palette.ACTIVE, palette.BLACK)
-        for db in cache.values():
-            db.close()
+        persistence.close()
         show_pattern(griode, PATTERN_DONE, palette.ACTIVE, palette.BLACK)
 
 
@@ -0,0 +1,89 @@
+import logging
+import mido
+import threading
+import time
+
+
+def device_class(port_name):
+    # Return the class to use to drive a given MIDI port (or None).
+    from launchpad import LaunchpadMK2, LaunchpadPro, LaunchpadS
+    from keyboard import Keyboard
+    klass = None
+    if "Launchpad Pro MIDI 2" in port_name:
+        klass = LaunchpadPro
+    if "Launchpad MK2" in port_name:
+        klass = LaunchpadMK2
+    if "Launchpad S" in port_name:
+        klass = LaunchpadS
+    if "Launchpad Mini" in port_name:
+        klass = LaunchpadS
+    if "reface" in port_name:
+        klass = Keyboard
+    return klass
+
+
+class Scanner(object):
+    """Detect MIDI devices being plugged or unplugged.
+
+    Enumerating MIDI ports, and opening and initializing new devices, is
+    slow (building a Launchpad and all its gridgets takes tens of ms, i.e.
+    a tick or more); so scan() runs in a background thread (see `start()`).
+    New devices are opened once they've been around for `settle` seconds,
+    without sleeping. When a device is ready, it's handed over to the
+    clock thread (with `clock.post()`), which only has to add it to
+    `griode.grids` and start processing its input; so `griode.grids` is
+    only ever changed by the clock thread.
+    """
+
+    def __init__(self, griode, interval=2, settle=4):
+        self.griode = griode
+        self.interval = interval  # how often we check (in seconds)
+        self.settle = settle      # how long we wait for new devices to settle
+        self.pending = {}         # port name -> when we first saw it
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="hotplug", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception:
+                logging.exception("Error while scanning MIDI ports")
+
+    def scan(self):
+        # This runs in the background (but never in the clock thread).
+        detected_ports = set(mido.get_ioport_names())
+        configured_ports = { grid.grid_name for grid in self.griode.grids }
+        now = time.monotonic()
+        for port_name in set(self.pending) - detected_ports:
+            # Unplugged before it had time to settle
+            del self.pending[port_name]
+        for port_name in detected_ports - configured_ports:
+            klass = device_class(port_name)
+            if klass is None:
+                continue
+            if port_name not in self.pending:
+                logging.info("Detected hotplug of new device: {}".format(port_name))
+                self.pending[port_name] = now
+                continue
+            if now - self.pending[port_name] < self.settle:
+                continue
+            del self.pending[port_name]
+            try:
+                grid = klass(self.griode, port_name)
+            except Exception:
+                logging.exception("Could not open device {}".format(port_name))
+                continue
+            self.griode.clock.post(self.attach, grid)
+        for port_name in configured_ports - detected_ports:
+            self.griode.clock.post(self.griode.remove_device, port_name)
+
+    def attach(self, grid):
+        # This runs in the clock thread.
+        self.griode.grids.append(grid)
+        grid.start()
@@ -30,13 +30,17 @@ class Keyboard(object):
 		self.port_name = port_name
 		self.grid_name = port_name # FIXME
 		self.midi_in = mido.open_input(port_name)
-		self.midi_in.callback = self.callback
 
 		self.loopcontroller = Dummy()
 		self.notepickers = Dummy()
 		self.arpconfigs = Dummy()
 		self.surface = {}
 
+	def start(self):
+		# Start processing input (in the clock thread; see hotplug.py)
+		self.midi_in.callback = lambda message: self.griode.clock.post(
+			self.callback, message)
+
 	def callback(self, message):
 		logging.debug("{} got message {}".format(self, message))
 		self.griode.devicechains[message.channel].send(message)
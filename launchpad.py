@@ -15,7 +15,13 @@ class LaunchPad(Grid):
             self.grid_out.send(message)
         self.surface = LPSurface(self)
         Grid.__init__(self, griode, port_name)
-        self.grid_in.callback = self.process_message
+
+    def start(self):
+        # Start processing input, once the device is ready (i.e. in the
+        # clock thread; see hotplug.py). Messages are processed by the
+        # clock thread too, not the rtmidi thread.
+        self.grid_in.callback = lambda message: self.griode.clock.post(
+            self.process_message, message)
 
     def process_message(self, message):
         logging.debug("{} got message {}".format(self, message))
@@ -0,0 +1,86 @@
+import ctypes
+import ctypes.util
+import logging
+
+
+class LibFluidsynth(object):
+    """Run fluidsynth in our own process, through its C API.
+
+    MIDI messages are turned into direct calls to the synth (instead of
+    going through the ALSA sequencer to a fluidsynth process). Fluidsynth
+    has its own audio thread, and its API is thread-safe, so `send()` can
+    be called from any thread.
+    """
+
+    def __init__(self, audio_driver, soundfonts, period_size=None, periods=None):
+        path = ctypes.util.find_library("fluidsynth")
+        if path is None:
+            raise OSError("Could not find libfluidsynth")
+        lib = self.lib = ctypes.CDLL(path)
+        pointer = ctypes.c_void_p
+        integer = ctypes.c_int
+        string = ctypes.c_char_p
+        for name, restype, argtypes in [
+                ("new_fluid_settings", pointer, []),
+                ("fluid_settings_setstr", integer, [pointer, string, string]),
+                ("fluid_settings_setint", integer, [pointer, string, integer]),
+                ("fluid_settings_setnum", integer, [pointer, string, ctypes.c_double]),
+                ("new_fluid_synth", pointer, [pointer]),
+                ("fluid_synth_sfload", integer, [pointer, string, integer]),
+                ("fluid_synth_set_bank_offset", integer, [pointer, integer, integer]),
+                ("new_fluid_audio_driver", pointer, [pointer, pointer]),
+                ("fluid_synth_noteon", integer, [pointer, integer, integer, integer]),
+                ("fluid_synth_noteoff", integer, [pointer, integer, integer]),
+                ("fluid_synth_cc", integer, [pointer, integer, integer, integer]),
+                ("fluid_synth_program_change", integer, [pointer, integer, integer]),
+                ("fluid_synth_pitch_bend", integer, [pointer, integer, integer]),
+        ]:
+            function = getattr(lib, name)
+            function.restype = restype
+            function.argtypes = argtypes
+
+        # Same settings as the fluidsynth process (see fluidsynth.py)
+        self.settings = lib.new_fluid_settings()
+        lib.fluid_settings_setstr(
+            self.settings, b"audio.driver", audio_driver.encode())
+        lib.fluid_settings_setstr(
+            self.settings, b"synth.midi-bank-select", b"mma")
+        lib.fluid_settings_setnum(self.settings, b"synth.sample-rate", 44100.0)
+        if period_size is not None:
+            lib.fluid_settings_setint(
+                self.settings, b"audio.period-size", period_size)
+        if periods is not None:
+            lib.fluid_settings_setint(self.settings, b"audio.periods", periods)
+
+        self.synth = lib.new_fluid_synth(self.settings)
+        for i, soundfont in enumerate(soundfonts):
+            font_id = lib.fluid_synth_sfload(self.synth, soundfont.encode(), 1)
+            if font_id < 0:
+                raise OSError("Could not load {}".format(soundfont))
+            lib.fluid_synth_set_bank_offset(self.synth, font_id, i*1000)
+        self.driver = lib.new_fluid_audio_driver(self.settings, self.synth)
+        if not self.driver:
+            raise OSError("Could not start audio driver {}".format(audio_driver))
+        logging.info("Started libfluidsynth ({})".format(path))
+
+    def send(self, message):
+        lib = self.lib
+        synth = self.synth
+        if message.type == "note_on":
+            # (A velocity of 0 is a note off; fluidsynth handles that.)
+            lib.fluid_synth_noteon(
+                synth, message.channel, message.note, message.velocity)
+        elif message.type == "note_off":
+            lib.fluid_synth_noteoff(synth, message.channel, message.note)
+        elif message.type == "control_change":
+            lib.fluid_synth_cc(
+                synth, message.channel, message.control, message.value)
+        elif message.type == "program_change":
+            lib.fluid_synth_program_change(
+                synth, message.channel, message.program)
+        elif message.type == "pitchwheel":
+            # mido uses -8192..8191; fluidsynth uses 0..16383
+            lib.fluid_synth_pitch_bend(
+                synth, message.channel, message.pitch + 8192)
+        else:
+            logging.debug("Ignoring message {}".format(message))
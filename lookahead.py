@@ -0,0 +1,154 @@
+import contextlib
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+
+
+# Controllers that must not be coalesced, even if they are sent twice
+# with the same value: data entry and (N)RPN selection (the same value
+# can mean different things depending on the selected parameter), and
+# channel mode messages (e.g. "all notes off").
+UNCOALESCED = {6, 38, 96, 97, 98, 99, 100, 101} | set(range(120, 128))
+
+# The sender is a regular Python thread. When another thread holds the
+# GIL (e.g. the clock thread computing the next tick), the sender has to
+# wait until the interpreter switches threads; by default, that's up to
+# 5 ms. So we make the interpreter switch more often.
+SWITCH_INTERVAL = 0.0005  # in seconds
+
+
+class Lookahead(object):
+    """Send MIDI messages at a precise time, from a dedicated thread.
+
+    All messages are handed over to a sender thread, so the threads
+    producing them (the clock, rtmidi callbacks...) never wait for
+    MIDI I/O.
+
+    When the lookahead window is non-zero, the clock runs each tick a
+    little bit *before* it is due. Messages generated while the clock
+    is rendering a tick (i.e. within `rendering()`) are timestamped
+    with the tick's due time, and the sender thread sends them when
+    that time comes. This way, if a tick takes a bit longer to compute
+    (garbage collection, LED redraw...) it doesn't affect the timing of
+    the notes, as long as we stay within the lookahead window.
+
+    Messages sent within `rendering()` or `batch()` are collected, and
+    queued all at once at the end of the block. Messages sent outside
+    of these blocks (e.g. from another thread) are queued right away.
+    Either way, messages that aren't timestamped are sent as soon as
+    possible.
+
+    Within `rendering()`, `delayed()` pushes the due time a bit later
+    (e.g. for notes recorded between two ticks). This works even when
+    there is no lookahead window.
+
+    Before sending, redundant messages are dropped: control changes
+    that don't change the value of the controller, and note offs for
+    notes that aren't playing.
+    """
+
+    def __init__(self, output, window):
+        self.output = output  # function to call to actually send a message
+        self.window = window  # in ns; 0 = no lookahead
+        self.heap = []        # (due_time, sequence_number, message)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        # These are only used by the sender thread
+        self.controls = {}    # (channel, control) -> last value sent
+        self.notes = set()    # (channel, note) currently playing
+        if sys.getswitchinterval() > SWITCH_INTERVAL:
+            sys.setswitchinterval(SWITCH_INTERVAL)
+        self.thread = threading.Thread(
+            target=self.run, name="lookahead", daemon=True)
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def batch(self, due=None):
+        self.local.due = due
+        self.local.batch = []
+        try:
+            yield
+        finally:
+            batch = self.local.batch
+            self.local.due = None
+            self.local.batch = None
+            self.queue(batch)
+
+    def rendering(self, due):
+        return self.batch(due)
+
+    @contextlib.contextmanager
+    def delayed(self, delay):
+        # Messages sent within this block are due `delay` ns later.
+        due = getattr(self.local, "due", None)
+        if due is not None:
+            self.local.due = due + delay
+        try:
+            yield
+        finally:
+            self.local.due = due
+
+    def send(self, message):
+        due = getattr(self.local, "due", None)
+        batch = getattr(self.local, "batch", None)
+        if batch is None:
+            self.queue([(due, message)])
+        else:
+            batch.append((due, message))
+
+    def queue(self, batch):
+        # Hand over a list of (due_time or None, message) to the sender.
+        if not batch:
+            return
+        now = time.perf_counter_ns()
+        with self.condition:
+            for due, message in batch:
+                if due is None:
+                    due = now
+                heapq.heappush(self.heap, (due, next(self.counter), message))
+            self.condition.notify()
+
+    def coalesce(self, messages):
+        for message in messages:
+            if message.type == "control_change":
+                key = (message.channel, message.control)
+                if message.control not in UNCOALESCED:
+                    if self.controls.get(key) == message.value:
+                        continue
+                    self.controls[key] = message.value
+                elif message.control in (120, 123):
+                    # All sound off, all notes off
+                    self.notes = {(channel, note) for (channel, note)
+                                  in self.notes if channel != message.channel}
+            elif message.type == "note_on" and message.velocity > 0:
+                self.notes.add((message.channel, message.note))
+            elif message.type in ("note_on", "note_off"):
+                key = (message.channel, message.note)
+                if key not in self.notes:
+                    continue
+                self.notes.discard(key)
+            yield message
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.condition:
+                while not heap:
+                    self.condition.wait()
+                delay = heap[0][0] - time.perf_counter_ns()
+                if delay > 0:
+                    self.condition.wait(delay / 1e9)
+                    continue
+                messages = []
+                now = time.perf_counter_ns()
+                while heap and heap[0][0] <= now:
+                    messages.append(heapq.heappop(heap)[2])
+            for message in self.coalesce(messages):
+                try:
+                    self.output(message)
+                except Exception:
+                    logging.exception("Error while sending {}".format(message))
@@ -1,16 +1,25 @@
+import bisect
 import logging
+import math
 import mido
 import time
 
+from alignment import Alignment
 import colors
+from events import Events, SUBTICKS
 from gridgets import Gridget, Surface
+from noteoff import NoteOffs
 from palette import palette
-from persistence import persistent_attrs, persistent_attrs_init
+from persistence import persistent_attrs, persistent_attrs_init, persistent_attrs_preload
+from quantize import Quantizer
 
 
 on_off_colors = palette.SWITCH
 
 
+# Notes used to be stored as Note objects (in a {tick: [Note, ...]} dict).
+# They're now stored in an Events object; but we keep that class around
+# so that we can load (and convert) loops saved in the old format.
 class Note(object):
 
     def __init__(self, note, velocity, duration):
@@ -23,15 +32,80 @@ class Note(object):
                 .format(self.note, self.velocity, self.duration))
 
 
+def upgrade_notes(notes):
+    if isinstance(notes, dict):
+        return Events.from_dict(notes)
+    return notes
+
+
 @persistent_attrs(
-    notes={}, channel=None, tick_in=0, tick_out=0, teach_interval=0)
+    notes=Events(), channel=None, tick_in=0, tick_out=0, teach_interval=0,
+    quantized=False)
 class Loop(object):
 
+    db_upgrade = dict(notes=upgrade_notes)
+
     def __init__(self, looper, cell):
         self.looper = looper
         self.cell = cell
-        persistent_attrs_init(self, "{},{}".format(*cell))
+        # Loops are loaded lazily: their notes are only read from the
+        # store when the loop is actually used (played, recorded, edited...)
+        persistent_attrs_init(self, "{},{}".format(*cell), lazy=True)
         self.next_tick = 0  # next "position" to be played in self.notes
+        # Position in self.playback() of the first note at (or after)
+        # cursor_tick. It's only valid if these notes haven't changed
+        # in the meantime.
+        self.cursor = 0
+        self.cursor_tick = None
+        self.cursor_notes = None
+        self.cursor_version = None
+        # Quantized copy of self.notes, and what it was computed from
+        self.view = None
+        self.view_key = None
+
+    def playback(self, settings=None):
+        # Return the notes to play. That's self.notes; or, if the loop
+        # is quantized, a quantized copy of them (so self.notes is never
+        # changed, and quantization can be undone). The copy is computed
+        # again when the notes or the quantization settings change.
+        # `settings` are the arguments of the Quantizer (by default,
+        # those of the Looper).
+        if not self.quantized:
+            return self.notes
+        if settings is None:
+            settings = self.looper.quantize_settings
+        notes = self.notes
+        key = (notes, notes.version, self.tick_in, self.tick_out, settings)
+        if self.view_key != key:
+            # Seed humanize with the cell, so notes don't move around
+            # each time a note is recorded.
+            quantizer = Quantizer(*settings, seed=repr(self.cell))
+            self.view = quantizer.apply(notes, self.tick_in, self.tick_out)
+            self.view_key = key
+        return self.view
+
+    def advance(self):
+        # Return the notes starting at next_tick, and move the cursor
+        # past them. When the loop plays continuously, this is just
+        # one comparison when there is no note to play. If next_tick
+        # jumped (because we rewound or looped), or if notes were added
+        # or removed (or quantized again), we re-synchronize the cursor.
+        notes = self.playback()
+        ticks = notes.ticks
+        tick = self.next_tick
+        if (self.cursor_tick != tick or self.cursor_notes is not notes or
+                self.cursor_version != notes.version):
+            self.cursor = bisect.bisect_left(ticks, tick)
+            self.cursor_notes = notes
+            self.cursor_version = notes.version
+        start = end = self.cursor
+        while end < len(ticks) and ticks[end] == tick:
+            end += 1
+        self.cursor = end
+        self.cursor_tick = tick + 1
+        if start == end:
+            return ()
+        return [notes[i] for i in range(start, end)]
 
     def __repr__(self):
         return "Loop({})".format(self.cell)
@@ -94,10 +168,9 @@ class Teacher(object):
         self.looper.loops_playing.clear()
         self.looper.loops_playing.add(self.teacher_loop)
         self.teacher_loop.next_tick = self.tick_in
-        self.teacher_notes = []
-        for tick in range(self.tick_in, self.tick_out):
-            for note in self.teacher_loop.notes.get(tick, []):
-                self.teacher_notes.append(note.note)
+        self.teacher_notes = [
+            (note.tick, note.note) for note in
+            self.teacher_loop.playback().between(self.tick_in, self.tick_out)]
         if self.teacher_notes == []:
             # A silence long enough will be interpreted as end of song
             self.stop()
@@ -111,46 +184,60 @@ class Teacher(object):
         self.looper.playing = False
         self.student_loop.notes.clear()
         self.student_loop.next_tick = 0
+        self.alignment = Alignment(self.teacher_notes)
+        self.last_note_tick = None
         self.looper.loops_recording.add(self.student_loop)
         self.looper.loops_playing.clear()
         self.flash(colors.YELLOW)
         self.looper.playing = True
 
+    def record(self, loop, tick, note):
+        # Called by the Looper each time a note is recorded.
+        # We don't change phase here (we're called while the Looper
+        # iterates over the recording loops); tick() will do it.
+        if self.phase != "STUDENT" or loop is not self.student_loop:
+            return
+        fits = self.alignment.add(tick, note)
+        self.last_note_tick = tick
+        logging.info("Student played {} at {}: {}"
+                     .format(note, tick, "OK" if fits else "wrong"))
+
     def tick(self, tick):
         if self.phase == "TEACHER":
             if self.teacher_loop.next_tick >= self.tick_out:
                 self.student()
         if self.phase == "STUDENT":
-            # Once per beat, check how we did in this loop
-            if tick%24 == 0:
-                student_notes = []
-                for tick in self.student_loop.notes:
-                    for note in self.student_loop.notes.get(tick, []):
-                        if note.duration > 0:
-                            student_notes.append(note.note)
-                if student_notes == self.teacher_notes:
-                    # Yay!
-                    logging.info("Got the right notes!")
-                    self.flash(colors.GREEN)
-                    self.tick_in += self.tick_interval
-                    self.tick_out += self.tick_interval
-                    self.teacher()
-                elif (any(x!=y for x, y in zip(self.teacher_notes, student_notes))
-                      or
-                      len(student_notes) > len(self.teacher_notes)
-                      or
-                      self.student_loop.next_tick >= 2*self.tick_interval):
-                    # Bzzzt wrong
-                    logging.info("Bzzzt try again!")
-                    logging.info("Teacher notes: {}"
-                                 .format(self.teacher_notes))
-                    logging.info("Student notes: {}"
-                                 .format(student_notes))
-                    self.flash(colors.RED)
-                    self.teacher()
-
-
-@persistent_attrs(beats_per_bar=4)
+            alignment = self.alignment
+            # Consider that the student is done if they played the phrase
+            # perfectly, or if they played it well enough and then stopped
+            # playing for a beat.
+            done = alignment.perfect or (
+                alignment.passed and
+                not self.looper.notes_recording and
+                self.student_loop.next_tick - self.last_note_tick >= 24)
+            if done:
+                # Yay!
+                logging.info("Got the right notes! ({} errors)"
+                             .format(alignment.score))
+                self.flash(colors.GREEN)
+                self.tick_in += self.tick_interval
+                self.tick_out += self.tick_interval
+                self.teacher()
+            elif (alignment.failed or
+                  self.student_loop.next_tick >= 2*self.tick_interval):
+                # Bzzzt wrong
+                logging.info("Bzzzt try again!")
+                logging.info("Teacher notes: {}"
+                             .format([note for tick, note in self.teacher_notes]))
+                logging.info("Student notes: {}"
+                             .format([note.note for note in self.student_loop.notes]))
+                self.flash(colors.RED)
+                self.teacher()
+
+
+@persistent_attrs(beats_per_bar=4, quantize_record=False, quantize_grid=12,
+                  quantize_strength=1.0, quantize_swing=0.0,
+                  quantize_humanize=0)
 class Looper(object):
 
     def __init__(self, griode):
@@ -160,32 +247,77 @@ class Looper(object):
         self.last_tick = 0            # Last (=current) tick
         self.loops_playing = set()    # Contains instances of Loop
         self.loops_recording = set()  # Also instances of Loop
-        self.notes_recording = {}     # note -> (Note(), tick_when_started)
-        self.notes_playing = []       # (stop_tick, channel, note)
+        self.notes_recording = {}     # note -> ([(loop, tick)], tick_when_started)
+        self.notes_playing = NoteOffs()
         self.loops = {}
         self.teacher = Teacher(self)
         for row in range(1, 9):
             for column in range(1, 9):
                 self.loops[row, column] = Loop(self, (row, column))
+        # The LoopController needs to know the channel of each loop
+        # (to show which ones are empty), so load these in one go.
+        persistent_attrs_preload(self.loops.values(), "channel")
 
     def send(self, message):
         if self.playing and message.type == "note_on":
             for loop in self.loops_recording:
                 if loop.channel == message.channel:
                     if message.velocity > 0:
-                        note = Note(message.note, message.velocity, 0)
-                        logging.info("recording {}...".format(note))
-                        if loop.next_tick not in loop.notes:
-                            loop.notes[loop.next_tick] = []
-                        loop.notes[loop.next_tick].append(note)
-                        self.notes_recording[message.note] = (note, self.last_tick)
-                    else:
-                        note, tick_started = self.notes_recording.pop(message.note)
-                        note.duration = self.last_tick - tick_started
-                        logging.info("recorded {}".format(note))
+                        logging.info("recording note {} in {}..."
+                                     .format(message.note, loop))
+                        tick, offset = self.record_position(loop)
+                        loop.notes.add(
+                            tick, message.note, message.velocity, 0, offset)
+                        self.teacher.record(loop, tick, message.note)
+                        recorded, _ = self.notes_recording.get(
+                            message.note, ([], None))
+                        recorded.append((loop, tick))
+                        self.notes_recording[message.note] = (
+                            recorded, self.last_tick)
+                    elif message.note in self.notes_recording:
+                        recorded, tick_started = self.notes_recording.pop(
+                            message.note)
+                        duration = self.last_tick - tick_started
+                        for loop, tick in recorded:
+                            loop.notes.set_duration(tick, message.note, duration)
+                        logging.info("recorded note {} (duration {})"
+                                     .format(message.note, duration))
         # No matter what: let the message through the chain
         self.output(message)
 
+    @property
+    def quantize_settings(self):
+        return (self.quantize_grid, self.quantize_strength,
+                self.quantize_swing, self.quantize_humanize)
+
+    @property
+    def quantizer(self):
+        return Quantizer(*self.quantize_settings)
+
+    def record_position(self, loop):
+        # Return the (tick, offset) where a note being recorded goes.
+        # loop.next_tick is the next position to be played, but the note
+        # was played a bit before that: when the input event arrived.
+        clock = self.griode.clock
+        position = loop.next_tick + clock.ticks_from(
+            clock.input_time, self.last_tick+1)
+        if self.quantize_record:
+            tick, offset = self.quantizer.tick(round(position)), 0
+        else:
+            tick = math.floor(position)
+            offset = round((position - tick) * SUBTICKS)
+            if offset == SUBTICKS:
+                tick, offset = tick+1, 0
+        # If that moves the note out of the loop, wrap it around
+        if loop.tick_out > 0:
+            if tick < loop.tick_in:
+                tick += loop.tick_out - loop.tick_in
+            if tick >= loop.tick_out:
+                tick -= loop.tick_out - loop.tick_in
+        if tick < 0:
+            tick, offset = 0, 0
+        return tick, offset
+
     def output(self, message):
         channel = message.channel
         devicechain = self.griode.devicechains[channel]
@@ -193,42 +325,63 @@ class Looper(object):
 
     def tick(self, tick):
         self.last_tick = tick
-        # First, check if there are notes that should be stopped.
-        notes_to_stop = [note for note in self.notes_playing if note[0] <= tick]
-        for note in notes_to_stop:
+        clock = self.griode.clock
+        # Figure out which notes should be started *now*
+        # (only if we are really playing, i.e. not paused)
+        starting = []
+        if self.playing:
+            for loop in self.loops_playing:
+                starting.extend((loop, note) for note in loop.advance())
+        # Then, check if there are notes that should be stopped.
+        # Notes recorded between two ticks are started (and so, stopped)
+        # a bit later; but if the same note starts again on this tick,
+        # it must be stopped before that.
+        restarting = {(loop.channel, note.note): note.offset
+                      for loop, note in starting}
+        for channel, note, offset in self.notes_playing.expire(tick):
+            offset = min(offset, restarting.get((channel, note), offset))
             message = mido.Message(
-                "note_on", channel=note[1], note=note[2], velocity=0)
-            self.output(message)
-            self.notes_playing.remove(note)
+                "note_on", channel=channel, note=note, velocity=0)
+            delay = offset * clock.tick_ns // SUBTICKS
+            with clock.lookahead.delayed(delay):
+                self.output(message)
             # Light off notepickers
             for grid in self.griode.grids:
-                grid.notepickers[note[1]].send(message, self)
+                grid.notepickers[channel].send(message, self)
         # Only play stuff if we are really playing (i.e. not paused)
         if not self.playing:
             return
-        # OK now, for each loop that is playing...
-        for loop in self.loops_playing:
-            # Figure out which notes should be started *now*
-            for note in loop.notes.get(loop.next_tick, []):
-                logging.info("Play {} from {}".format(note, loop))
-                self.notes_playing.append(
-                    (tick+note.duration, loop.channel, note.note))
-                message = mido.Message(
-                    "note_on", channel=loop.channel,
-                    note=note.note, velocity=note.velocity)
+        # OK now, start the notes of each loop that is playing
+        for loop, note in starting:
+            logging.info("Play {} from {}".format(note, loop))
+            self.notes_playing.add(
+                tick+note.duration, loop.channel, note.note, note.offset)
+            message = mido.Message(
+                "note_on", channel=loop.channel,
+                note=note.note, velocity=note.velocity)
+            # Notes recorded between two ticks are sent a bit later
+            delay = note.offset * clock.tick_ns // SUBTICKS
+            with clock.lookahead.delayed(delay):
                 self.output(message)
-                # Light up notepickers
-                for grid in self.griode.grids:
-                    grid.notepickers[loop.channel].send(message, self)
+            # Light up notepickers
+            for grid in self.griode.grids:
+                grid.notepickers[loop.channel].send(message, self)
         # Advance each loop that is currently playing or recording
-        for loop in self.loops_playing | self.loops_recording:
-            loop.next_tick += 1
-            # If we're past the end of the loop, jump to begin of loop
-            if loop.tick_out > 0 and loop.next_tick >= loop.tick_out:
-                loop.next_tick = loop.tick_in
+        for loop in self.loops_playing:
+            self.advance(loop)
+        for loop in self.loops_recording:
+            if loop not in self.loops_playing:
+                self.advance(loop)
         # Teacher logic
         self.teacher.tick(tick)
 
+    def advance(self, loop):
+        loop.next_tick += 1
+        # If we're past the end of the loop, jump to begin of loop
+        # (the loop's cursor will notice and re-synchronize itself)
+        if loop.tick_out > 0 and loop.next_tick >= loop.tick_out:
+            loop.next_tick = loop.tick_in
+
 class LoopController(Gridget):
 
     """
@@ -244,8 +397,10 @@ class LoopController(Gridget):
         self.surface = Surface(grid.surface)
         self.loopeditor = LoopEditor(grid)
         self.stepsequencer = StepSequencer(grid)
+        self.quantizeconfig = QuantizeConfig(grid)
         self.mode = "LEARN"  # or "REC" or "PLAY"
         self.pads_held = {}  # maps pad to time when pressed
+        self.drawn_state = None  # what self.state() was when we last drew
         self.draw()
 
     @property
@@ -274,8 +429,24 @@ class LoopController(Gridget):
                 return color
         return color
 
-    def draw(self):
-        for led in self.surface:
+    def state(self):
+        # Everything that can change what draw() shows on its own.
+        # (When a loop is created or deleted, draw() is called explicitly.)
+        # The blink phase is last; it only matters if something blinks.
+        looper = self.looper
+        phase = None
+        if looper.loops_playing or looper.loops_recording:
+            tick = looper.last_tick
+            phase = (tick % 48 > 24, tick % 24 > 18, tick % 12 > 4)
+        return (frozenset(looper.loops_playing),
+                frozenset(looper.loops_recording),
+                looper.playing, self.mode, bool(self.pads_held), phase)
+
+    def draw(self, leds=None):
+        # Redraw the given leds (by default, all of them).
+        if leds is None:
+            leds = self.surface
+        for led in leds:
             if isinstance(led, tuple):
                 color = colors.GREY_LO
                 loop = self.looper.loops[led]
@@ -310,9 +481,21 @@ class LoopController(Gridget):
                 self.loopeditor.loop = loop
                 self.grid.focus(self.loopeditor)
                 break
-        self.draw()
-        self.loopeditor.draw()
-        self.stepsequencer.draw()
+        # Only redraw if we're visible, and if something changed.
+        # If only the blink phase changed, only redraw what blinks.
+        if not self.surface.visible:
+            self.drawn_state = None
+        else:
+            state = self.state()
+            old_state, self.drawn_state = self.drawn_state, state
+            if old_state is None or old_state[:-1] != state[:-1]:
+                self.draw()
+            elif old_state != state:
+                loops = self.looper.loops_playing | self.looper.loops_recording
+                self.draw([loop.cell for loop in loops
+                           if isinstance(loop.cell, tuple)])
+        self.loopeditor.tick(tick)
+        self.stepsequencer.tick(tick)
 
     def pad_pressed(self, row, column, velocity):
         # We don't act when the pad is pressed, but when it is released.
@@ -385,8 +568,8 @@ class LoopController(Gridget):
         if button == "RIGHT":
             if self.looper.playing:
                 for loop in self.looper.loops_recording:
-                    # Save! Save all the things!
-                    loop.db.sync()
+                    # (No need to save the loop here; this happens
+                    # automatically in the background.)
                     # I'm not sure that this logic should be here,
                     # but it should be somewhere, so here we go...
                     # When stopping, if any loop doesn't have a
@@ -407,6 +590,7 @@ class CellPicker(Gridget):
         self.surface = Surface(grid.surface)
         self.ticks_per_cell = 12
         self._loop = None
+        self.drawn_state = None  # what self.state() was when we last drew
 
     @property
     def loop(self):
@@ -415,12 +599,47 @@ class CellPicker(Gridget):
     @loop.setter
     def loop(self, value):
         self._loop = value
+        self.drawn_state = None
         self.draw()
 
     def rc2cell(self, row, column):
         # Map row,column to a cell number (starting at zero)
         return (8-row)*8 + column-1
 
+    def cell2rc(self, cell):
+        return 8 - cell//8, cell%8 + 1
+
+    def position(self):
+        # Return the cell currently being played (or None)
+        looper = self.loop.looper
+        if looper.playing:
+            if (self.loop in looper.loops_playing or
+                    self.loop in looper.loops_recording):
+                return self.loop.next_tick // self.ticks_per_cell
+        return None
+
+    def state(self):
+        # Everything that draw() depends on. The play position is last.
+        loop = self.loop
+        return (loop, loop.notes.version, loop.channel,
+                loop.tick_in, loop.tick_out, self.position())
+
+    def tick(self, tick):
+        # Only redraw if we're visible, and if something changed.
+        # If only the play position changed, only redraw the cells
+        # that it left and entered.
+        if self.loop is None or not self.surface.visible:
+            self.drawn_state = None
+            return
+        state = self.state()
+        old_state, self.drawn_state = self.drawn_state, state
+        if old_state is None or old_state[:-1] != state[:-1]:
+            self.draw()
+        elif old_state != state:
+            cells = [old_state[-1], state[-1]]
+            self.draw([self.cell2rc(cell) for cell in cells
+                       if cell is not None and cell < 64])
+
     def rc2ticks(self, row, column):
         # Return list of ticks in a given cell
         cell = self.rc2cell(row, column)
@@ -433,27 +652,34 @@ class LoopEditor(CellPicker):
         super().__init__(grid)
         self.action = None
 
-    def draw(self):
+    def state(self):
+        # We show the notes as they are played (maybe quantized).
+        return (self.loop.playback(),) + super().state()
+
+    def draw(self, leds=None):
         if self.loop is None:
             return
-        for led in self.surface:
+        if leds is None:
+            leds = self.surface
+        position = self.position()
+        occupancy = self.loop.playback().cells(self.ticks_per_cell)
+        for led in leds:
             if isinstance(led, tuple):
                 row, column = led
                 color = palette.BLACK
                 ticks = self.rc2ticks(row, column)
-                for tick in ticks:
-                    if tick in self.loop.notes:
-                        color = colors.GREY_LO
-                if self.loop.looper.playing:
-                    if self.loop in (self.loop.looper.loops_playing |
-                                     self.loop.looper.loops_recording):
-                        if self.loop.next_tick in ticks:
-                            color = palette.CHANNEL[self.loop.channel]
+                cell = self.rc2cell(row, column)
+                if occupancy.has_first(cell) or occupancy.has_other(cell):
+                    color = colors.GREY_LO
+                if position == cell:
+                    color = palette.CHANNEL[self.loop.channel]
                 if self.loop.tick_in in ticks:
                     color = colors.PINK_HI
                 if self.loop.tick_out-1 in ticks:
                     color = colors.PINK_HI
                 self.surface[led] = color
+        # RIGHT = quantize (or not) when playing
+        self.surface["RIGHT"] = on_off_colors[self.loop.quantized]
 
     def pad_pressed(self, row, column, velocity):
         if velocity == 0:
@@ -482,14 +708,14 @@ class LoopEditor(CellPicker):
                 logging.info("Action is now SET_TICK_IN")
                 self.action = "SET_TICK_IN"
             else:
-                for tick in ticks:
-                    for note in self.loop.notes.get(tick, []):
-                        # FIXME: Send note_off message when the pad is released
-                        message = mido.Message(
-                            "note_on", channel=self.loop.channel,
-                            note=note.note, velocity=note.velocity)
-                        self.grid.griode.synth.send(message)
-                        self.grid.griode.synth.send(message.copy(velocity=0))
+                notes = self.loop.playback()
+                for note in notes.between(ticks[0], ticks[-1]+1):
+                    # FIXME: Send note_off message when the pad is released
+                    message = mido.Message(
+                        "note_on", channel=self.loop.channel,
+                        note=note.note, velocity=note.velocity)
+                    self.grid.griode.synth.send(message)
+                    self.grid.griode.synth.send(message.copy(velocity=0))
         self.draw()
 
     def button_pressed(self, button):
@@ -498,6 +724,16 @@ class LoopEditor(CellPicker):
         if button == "DOWN":
             self.grid.loopcontroller.stepsequencer.loop = self.loop  # FIXME urgh
             self.grid.focus(self.grid.loopcontroller.stepsequencer)
+        if button == "LEFT":
+            self.grid.loopcontroller.quantizeconfig.loop = self.loop
+            self.grid.focus(self.grid.loopcontroller.quantizeconfig)
+        if button == "RIGHT":
+            # The notes themselves don't change, so this can be undone
+            # by pressing RIGHT again.
+            self.loop.quantized = not self.loop.quantized
+            logging.info("Loop {} quantized: {}"
+                         .format(self.loop, self.loop.quantized))
+            self.draw()
 
 class StepSequencer(CellPicker):
 
@@ -509,10 +745,19 @@ class StepSequencer(CellPicker):
     def notepicker(self):
         return self.grid.notepickers[self.grid.channel]
 
-    def draw(self):
+    def state(self):
+        # The bottom half mirrors the notepicker, so redraw when it changes.
+        return ((self.note, self.notepicker.surface.version) +
+                super().state())
+
+    def draw(self, leds=None):
         if self.loop is None:
             return
-        for led in self.surface:
+        if leds is None:
+            leds = self.surface
+        position = self.position()
+        occupancy = self.loop.notes.cells(self.ticks_per_cell)
+        for led in leds:
             if isinstance(led, tuple):
                 row, column = led
                 if row in [1, 2, 3, 4]:
@@ -522,11 +767,10 @@ class StepSequencer(CellPicker):
                             color = colors.PINK_HI
                 else:
                     color = palette.BLACK
-                    ticks = self.rc2ticks(row, column)
+                    cell = self.rc2cell(row, column)
                     # Show if there are notes in this cell
-                    has_first = bool(self.loop.notes.get(ticks[0]))
-                    has_other = any(bool(self.loop.notes.get(tick))
-                                    for tick in ticks[1:])
+                    has_first = occupancy.has_first(cell)
+                    has_other = occupancy.has_other(cell)
                     if has_first and has_other:
                         color = colors.GREY_LO
                     if has_first and not has_other:
@@ -534,15 +778,11 @@ class StepSequencer(CellPicker):
                     if not has_first and has_other:
                         color = colors.GREY_LO
                     # And now, override that color if the current note is there
-                    for note in self.loop.notes.get(ticks[0], []):
-                        if note.note == self.note:
-                            color = colors.PINK_HI
+                    if occupancy.has_note(cell, self.note):
+                        color = colors.PINK_HI
                     # But override even more to show the current play position
-                    if self.loop.looper.playing:
-                        if self.loop in (self.loop.looper.loops_playing |
-                                         self.loop.looper.loops_recording):
-                            if self.loop.next_tick in ticks:
-                                color = colors.AMBER_HI
+                    if position == cell:
+                        color = colors.AMBER_HI
                 self.surface[led] = color
 
     def pad_pressed(self, row, column, velocity):
@@ -556,16 +796,86 @@ class StepSequencer(CellPicker):
             if self.note is None:
                 return
             ticks = self.rc2ticks(row, column)
-            for note in self.loop.notes.get(ticks[0], []):
-                if note.note == self.note:
-                    self.loop.notes[ticks[0]].remove(note)
-                    break
-            else:
-                if ticks[0] not in self.loop.notes:
-                    self.loop.notes[ticks[0]] = []
-                self.loop.notes[ticks[0]].append(
-                    Note(note=self.note, velocity=velocity, duration=self.ticks_per_cell))
+            if not self.loop.notes.remove(ticks[0], self.note):
+                self.loop.notes.add(
+                    ticks[0], self.note, velocity, self.ticks_per_cell)
 
     def button_pressed(self, button):
         if button == "UP":
             self.grid.focus(self.grid.loopcontroller.loopeditor)
+
+
+# Values that can be picked (one per column) for each quantize setting
+QUANTIZE_ROWS = {
+    6: ("quantize_grid", [3, 4, 6, 8, 12, 16, 24, 48]),
+    4: ("quantize_strength", [column/8 for column in range(1, 9)]),
+    3: ("quantize_swing", [column/12 for column in range(8)]),
+    2: ("quantize_humanize", list(range(8))),
+}
+
+
+class QuantizeConfig(Gridget):
+
+    """
+    Row 8: 1 = quantize notes while recording, 2 = play this loop quantized
+    Row 6: grid (from 1/32 note to half note)
+    Row 4: strength (from 1/8 to all the way)
+    Row 3: swing (from none to 7/12 of the grid)
+    Row 2: humanize (from 0 to 7 ticks)
+
+    The settings are the Looper's, so they apply to all the loops.
+    UP or LEFT = back to the loop editor
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.surface = Surface(grid.surface)
+        self._loop = None
+
+    @property
+    def looper(self):
+        return self.grid.griode.looper
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @loop.setter
+    def loop(self, value):
+        self._loop = value
+        self.draw()
+
+    def draw(self):
+        looper = self.looper
+        for led in self.surface:
+            if isinstance(led, tuple):
+                row, column = led
+                color = palette.BLACK
+                if led == (8, 1):
+                    color = on_off_colors[looper.quantize_record]
+                if led == (8, 2):
+                    color = on_off_colors[self.loop.quantized]
+                if row in QUANTIZE_ROWS:
+                    attr_name, values = QUANTIZE_ROWS[row]
+                    color = on_off_colors[
+                        getattr(looper, attr_name) == values[column-1]]
+                self.surface[led] = color
+
+    def pad_pressed(self, row, column, velocity):
+        if velocity == 0:
+            return
+        looper = self.looper
+        if (row, column) == (8, 1):
+            looper.quantize_record = not looper.quantize_record
+        if (row, column) == (8, 2):
+            self.loop.quantized = not self.loop.quantized
+        if row in QUANTIZE_ROWS:
+            attr_name, values = QUANTIZE_ROWS[row]
+            setattr(looper, attr_name, values[column-1])
+            logging.info("Looper {} = {}"
+                         .format(attr_name, values[column-1]))
+        self.draw()
+
+    def button_pressed(self, button):
+        if button in ["UP", "LEFT"]:
+            self.grid.focus(self.grid.loopcontroller.loopeditor)
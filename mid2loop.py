@@ -1,53 +1,139 @@
 #!/usr/bin/env python3
 
+import argparse
+import concurrent.futures
+import glob
+import math
 import mido
-import sys
-
-from looper import Loop, Note
-
-# Syntax: mid2loop <foo.mid> <row> <col> <bars_to_loop>
-
-midi_file = mido.MidiFile(filename=sys.argv[1])
-cell = sys.argv[2:4]
-bars = int(sys.argv[4])
-
-loop = Loop(looper=None, cell=cell)
-
-loop.notes.clear()
-loop.channel = 3
-
-def quantize(t, q):
-	return q*round(t/q)
-
-def time2tick(t):
-	return quantize(24 * t / tempo * 1000000, 6)
-
-now = 0
-tempo = 0 # microseconds per quarter note
-notes = {} # note -> start_time
-for message in midi_file:
-	now += message.time
-	if message.type == "time_signature":
-		print("# time signature: {}/{}".format(message.numerator, message.denominator))
-		loop.teach_interval = bars * 24 * message.numerator
-	if message.type == "set_tempo":
-		tempo = message.tempo
-	if message.type == "note_on" and message.velocity > 0:
-		notes[message.note] = now
-	elif message.type in ("note_on", "note_off"):
-		start_time = notes.pop(message.note, None)
-		if start_time is None:
-			print("# unmatched note: {}".format(message.note))
+import os
+
+from events import Events, SUBTICKS
+from quantize import Quantizer
+
+# Syntax: mid2loop [options] <bars_to_loop> <source>...
+# Each source is a .mid file or a directory of .mid files, optionally
+# followed by @<row>,<col> to pick the cell where (the first file) goes.
+# Other files go in the following cells.
+# E.g.: mid2loop 2 songs/intro.mid@1,1 songs/more/
+
+parser = argparse.ArgumentParser(description="Import MIDI files into loops.")
+parser.add_argument(
+	"bars", type=int,
+	help="number of bars for each teaching phrase")
+parser.add_argument(
+	"sources", nargs="+", metavar="source",
+	help="file.mid or directory, optionally followed by @row,col")
+parser.add_argument(
+	"-q", "--quantize", type=int, default=6,
+	help="quantization grid, in ticks (0 = don't quantize)")
+parser.add_argument(
+	"-c", "--channel", type=int, action="append",
+	help="only import notes from that MIDI channel "
+	"(0-15, can be repeated; default = all channels)")
+parser.add_argument(
+	"-l", "--loop-channel", type=int, default=3,
+	help="channel of the loops")
+parser.add_argument(
+	"-j", "--jobs", type=int, default=None,
+	help="number of files to parse in parallel")
+
+
+def load(path, grid, channels):
+	# Parse a MIDI file. Return (Events, time signature numerator or None).
+	# This runs in a worker process, so it must not touch the state store.
+	# Positions are computed in musical time (MIDI ticks per beat), so
+	# tempo changes don't affect them; loops follow Griode's tempo anyway.
+	midi_file = mido.MidiFile(filename=path)
+	scale = 24 / midi_file.ticks_per_beat
+	quantizer = Quantizer(grid)
+	events = Events()
+	numerator = None
+	now = 0
+	started = {}  # (channel, note) -> (start position, velocity)
+	for message in mido.merge_tracks(midi_file.tracks):
+		now += message.time
+		if message.type == "time_signature" and numerator is None:
+			numerator = message.numerator
+		if message.type not in ("note_on", "note_off"):
+			continue
+		if channels and message.channel not in channels:
+			continue
+		key = (message.channel, message.note)
+		if message.type == "note_on" and message.velocity > 0:
+			started[key] = (now * scale, message.velocity)
+			continue
+		if key not in started:
+			continue
+		start, velocity = started.pop(key)
+		duration = round(now * scale - start)
+		if grid > 0:
+			tick, offset = quantizer.tick(round(start)), 0
+			duration = quantizer.duration(duration)
 		else:
-			duration = now - start_time
-			start_tick = time2tick(start_time)
-			duration_tick = time2tick(duration)
-			print(message.note, start_tick, duration_tick)
-			if start_tick not in loop.notes:
-				loop.notes[start_tick] = []
-			loop.notes[start_tick].append(Note(message.note, 108, duration_tick))
-
-from persistence import cache
-for db in cache.values():
-	db.close()
+			tick = math.floor(start)
+			offset = round((start - tick) * SUBTICKS)
+			if offset == SUBTICKS:
+				tick, offset = tick+1, 0
+		events.add(tick, message.note, velocity, duration, offset)
+	return events, numerator
+
+
+def midi_files(source):
+	# Return the list of (path, cell or None) for a command-line source
+	path, _, cell = source.partition("@")
+	cell = tuple(int(x) for x in cell.split(",")) if cell else None
+	if os.path.isdir(path):
+		paths = sorted(
+			glob.glob(os.path.join(path, "*.mid")) +
+			glob.glob(os.path.join(path, "*.MID")))
+	else:
+		paths = [path]
+	return [(path, cell if i == 0 else None) for i, path in enumerate(paths)]
+
+
+def next_cell(cell):
+	row, column = cell
+	if column < 8:
+		return row, column+1
+	return row+1, 1
+
+
+def main():
+	args = parser.parse_args()
+
+	jobs = []  # (path, cell)
+	cell = (1, 1)
+	for source in args.sources:
+		for path, explicit_cell in midi_files(source):
+			if explicit_cell is not None:
+				cell = explicit_cell
+			if cell[0] > 8:
+				parser.error("No cell left for {}".format(path))
+			jobs.append((path, cell))
+			cell = next_cell(cell)
+
+	# Parse all the files in parallel...
+	paths = [path for path, cell in jobs]
+	with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+		results = list(executor.map(
+			load, paths, [args.quantize]*len(paths), [args.channel]*len(paths)))
+
+	# ... then update the loops, and save everything in one transaction.
+	# (This is imported here, so that worker processes don't need it.)
+	import persistence
+	from looper import Loop
+	loops = []  # keep them around until they're saved
+	for (path, cell), (events, numerator) in zip(jobs, results):
+		print("# {} -> {}: {} notes".format(path, cell, len(events)))
+		loop = Loop(looper=None, cell=cell)
+		loops.append(loop)
+		loop.notes = events
+		loop.channel = args.loop_channel
+		if numerator is not None:
+			print("# {} beats per bar".format(numerator))
+			loop.teach_interval = args.bars * 24 * numerator
+	persistence.close()
+
 
+if __name__ == "__main__":
+	main()
@@ -1,7 +1,12 @@
 #!/bin/sh
+SHORT=""
+LONG=""
 for N in $(seq 1 8);
 do
 	[ -f songs/$N.mid ] || continue
-	./mid2loop.py songs/$N.mid 1 $N 2
-	./mid2loop.py songs/$N.mid 2 $N 4
+	SHORT="$SHORT songs/$N.mid@1,$N"
+	LONG="$LONG songs/$N.mid@2,$N"
 done
+[ -n "$SHORT" ] || exit 0
+./mid2loop.py 2 $SHORT
+./mid2loop.py 4 $LONG
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Migrate state files from the old format (one shelve file per object,
+# in state/*.sav) to the single SQLite store (state/griode.sqlite).
+# Syntax: migrate.py [state_directory]
+
+import glob
+import os
+import pickle
+import shelve
+import sys
+
+import persistence
+
+directory = sys.argv[1] if len(sys.argv) > 1 else "state"
+
+# Depending on the dbm backend, a shelf "foo.sav" can be stored as
+# "foo.sav", "foo.sav.db", or "foo.sav.dat" + "foo.sav.dir" + "foo.sav.bak".
+filenames = set()
+for path in glob.glob(os.path.join(directory, "*.sav*")):
+    for suffix in [".db", ".dat", ".dir", ".bak"]:
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    filenames.add(path)
+
+rows = []
+for filename in sorted(filenames):
+    db = shelve.open(filename, "r")
+    # Objects are keyed by their db_filename, which is always "state/..."
+    key = "state/" + os.path.basename(filename)
+    for attr_name in db:
+        rows.append((key, attr_name, pickle.dumps(db[attr_name])))
+    print("{}: {} attributes".format(key, len(db)))
+    db.close()
+
+store_filename = os.path.join(directory, "griode.sqlite")
+store = persistence.Store(store_filename)
+store.save(rows)
+store.close()
+print("Migrated {} attributes from {} files to {}"
+      .format(len(rows), len(filenames), store_filename))
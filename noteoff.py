@@ -0,0 +1,43 @@
+import heapq
+
+
+class NoteOffs(object):
+    """Keep track of the notes that are playing, and when to stop them.
+
+    This is a min-heap of (stop_tick, offset, channel, note), plus a dict
+    giving the current stop time of each (channel, note). The offset is
+    in 1/SUBTICKS of a tick (see events.py); it lets notes started between
+    two ticks stop between two ticks too, so they keep their duration.
+    If a note is started again while it's still playing, we only keep
+    the latest stop time; so the first note-off doesn't cut the second
+    note short, and each note gets exactly one note-off.
+    """
+
+    def __init__(self):
+        self.heap = []   # (stop_tick, offset, channel, note)
+        self.stops = {}  # (channel, note) -> (stop_tick, offset)
+
+    def __len__(self):
+        return len(self.stops)
+
+    def add(self, stop_tick, channel, note, offset=0):
+        key = (channel, note)
+        stop = (stop_tick, offset)
+        current = self.stops.get(key)
+        if current is not None and current >= stop:
+            return
+        self.stops[key] = stop
+        heapq.heappush(self.heap, (stop_tick, offset, channel, note))
+
+    def expire(self, tick):
+        # Return the list of (channel, note, offset) that should stop at
+        # (or before) that tick, and forget about them.
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= tick:
+            stop_tick, offset, channel, note = heapq.heappop(heap)
+            # Skip entries that were superseded by a later stop time
+            if self.stops.get((channel, note)) == (stop_tick, offset):
+                del self.stops[channel, note]
+                expired.append((channel, note, offset))
+        return expired
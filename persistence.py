@@ -1,36 +1,246 @@
+import copy
+import glob
 import logging
-import shelve
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
 
-cache = {}
+STORE_FILENAME = "state/griode.sqlite"
 
-def shelve_open(filename):
-    if filename not in cache:
-        cache[filename] = shelve.open(filename, writeback=True)
-    return cache[filename]
+store = None
+instances = weakref.WeakSet()  # all objects that have persistent attributes
+# Objects can be created in other threads (e.g. new devices, in the hotplug
+# thread) while flush() enumerates them.
+instances_lock = threading.Lock()
+
+class Store(object):
+    # All the persistent state lives in a single SQLite database.
+    # Each persistent attribute is one row, keyed by the object's
+    # db_filename (e.g. "state/Loop__1,1.sav") and the attribute name.
+    # The value is pickled.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Each flush is fsync'ed; that's OK since flushes happen in the
+        # background, and it means that a power cut loses only the
+        # changes made since the last flush.
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS attrs ("
+            "filename TEXT, attr TEXT, value BLOB, "
+            "PRIMARY KEY (filename, attr))")
+
+    def load(self, filename):
+        # Return {attr_name: pickled_value} for a given object.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT attr, value FROM attrs WHERE filename=?",
+                (filename, )).fetchall()
+        return dict(rows)
+
+    def load_attr(self, filename, attr_name):
+        # Return the pickled value of one attribute (or None).
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM attrs WHERE filename=? AND attr=?",
+                (filename, attr_name)).fetchone()
+        return row[0] if row else None
+
+    def load_column(self, attr_name):
+        # Return {filename: pickled_value} for one attribute of all objects.
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT filename, value FROM attrs WHERE attr=?",
+                (attr_name, )).fetchall()
+        return dict(rows)
+
+    def save(self, rows):
+        # Save a list of (filename, attr_name, pickled_value) in one go.
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO attrs (filename, attr, value) "
+                    "VALUES (?, ?, ?)", rows)
+                self.connection.execute("COMMIT")
+            except Exception:
+                # Don't leave the transaction open: the next BEGIN
+                # would fail, and nothing would ever be saved again.
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def get_store():
+    global store
+    if store is None:
+        logging.debug("Opening state store {}".format(STORE_FILENAME))
+        if not os.path.exists(STORE_FILENAME) and glob.glob("state/*.sav*"):
+            logging.warning("Found state files in the old format (state/*.sav). "
+                            "Run ./migrate.py to import them.")
+        store = Store(STORE_FILENAME)
+    return store
+
+class PersistentAttr(object):
+    # Persistent attributes are loaded from the store the first time
+    # they are accessed; then they are kept in the instance __dict__.
+    # This descriptor has no __set__, so from then on, the instance
+    # __dict__ wins: reading (or assigning) them is a plain attribute
+    # access, and this code doesn't even run. Changes are detected by
+    # flush() (see persistent_attrs_changes).
+
+    def __init__(self, attr_name, default_value):
+        self.attr_name = attr_name
+        self.default_value = default_value
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.load(instance)
+
+    def load(self, instance):
+        if instance.db_lazy and self.attr_name not in instance.db_saved:
+            data = get_store().load_attr(instance.db_filename, self.attr_name)
+            if data is not None:
+                instance.db_saved[self.attr_name] = data
+        if self.attr_name in instance.db_saved:
+            value = pickle.loads(instance.db_saved[self.attr_name])
+            # Classes can provide functions to convert values saved
+            # in an older format, in a `db_upgrade` dict.
+            upgrade = getattr(instance, "db_upgrade", {}).get(self.attr_name)
+            if upgrade is not None:
+                value = upgrade(value)
+        else:
+            logging.debug(
+                "Initializing {}/{} with default value {}"
+                .format(instance.db_filename, self.attr_name,
+                        self.default_value))
+            # Make a copy, so that instances don't share mutable defaults.
+            # (It isn't in db_saved, so it will be saved by flush().)
+            value = copy.deepcopy(self.default_value)
+        instance.__dict__[self.attr_name] = value
+        return value
 
 def persistent_attrs(**kwargs):
     def wrap_class(klass):
         for attr_name, default_value in kwargs.items():
-            def getter(self, attr_name=attr_name, default_value=default_value):
-                if attr_name not in self.db:
-                    logging.debug(
-                        "Initializing {}/{} with default value {}"
-                        .format(self.db_filename, attr_name, default_value))
-                    self.db[attr_name] = default_value
-                return self.db[attr_name]
-            def setter(self, value, attr_name=attr_name):
-                logging.debug(
-                    "Setting {}/{} to {}"
-                    .format(self.db_filename, attr_name, value))
-                self.db[attr_name] = value
-            setattr(klass, attr_name, property(getter, setter))
+            setattr(klass, attr_name, PersistentAttr(attr_name, default_value))
+        klass.db_attrs = getattr(klass, "db_attrs", ()) + tuple(kwargs)
         return klass
     return wrap_class
 
-def persistent_attrs_init(self, id_str=None):
+def persistent_attrs_init(self, id_str=None, lazy=False):
+    # If lazy is True, nothing is loaded now: each attribute is loaded
+    # from the store the first time it is accessed. This is useful for
+    # objects that are numerous, but not always used (e.g. loops).
     if id_str is None:
         self.db_filename = "state/{}.sav".format(self.__class__.__name__)
     else:
         self.db_filename = "state/{}__{}.sav".format(self.__class__.__name__, id_str)
-    logging.debug("Opening shelf {}".format(self.db_filename))
-    self.db = shelve_open(self.db_filename)
+    self.db_lazy = lazy
+    if lazy:
+        self.db_saved = {}  # attr -> pickle (filled as attributes are loaded)
+    else:
+        logging.debug("Loading {}".format(self.db_filename))
+        self.db_saved = get_store().load(self.db_filename)
+    with instances_lock:
+        instances.add(self)
+
+def persistent_attrs_preload(objects, attr_name):
+    # Load one attribute of many (lazy) objects with a single query.
+    column = get_store().load_column(attr_name)
+    for obj in objects:
+        if obj.db_filename in column:
+            obj.db_saved[attr_name] = column[obj.db_filename]
+
+def persistent_attrs_changes(self):
+    # Return the (filename, attr_name, pickled_value) that changed
+    # since last time they were saved. (db_saved is only updated by
+    # flush(), once these changes are actually in the store.)
+    # Assignments aren't tracked (that would slow down every assignment
+    # of every attribute of the object), so we pickle every attribute
+    # that was loaded (or assigned), and compare with what was saved.
+    # That's cheap: most of them are small values.
+    # This can run in a background thread, while the clock thread keeps
+    # changing things. If a container is modified while we pickle it,
+    # we try again next time.
+    changes = []
+    values = self.__dict__
+    for attr_name in self.db_attrs:
+        if attr_name not in values:
+            continue  # never loaded or assigned, so it can't have changed
+        try:
+            data = pickle.dumps(values[attr_name])
+        except RuntimeError:
+            continue
+        if data != self.db_saved.get(attr_name):
+            logging.debug("Saving {}/{}".format(self.db_filename, attr_name))
+            changes.append((self.db_filename, attr_name, data))
+    return changes
+
+def flush():
+    # Save everything that changed, in a single transaction.
+    # If that fails, db_saved isn't updated, so the next flush
+    # will try to save these changes again.
+    changes = []  # (instance, (filename, attr_name, pickled_value))
+    with instances_lock:
+        snapshot = list(instances)
+    for instance in snapshot:
+        for change in persistent_attrs_changes(instance):
+            changes.append((instance, change))
+    if not changes:
+        return
+    get_store().save([change for instance, change in changes])
+    for instance, (filename, attr_name, data) in changes:
+        instance.db_saved[attr_name] = data
+
+class Flusher(object):
+    # Periodically save what changed, from a background thread.
+    # This way, the clock thread never waits for the disk.
+
+    current = None  # the one started by start_flusher()
+
+    def __init__(self, interval=2):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="flusher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                t0 = time.perf_counter()
+                flush()
+                logging.debug("Flushed state in {:.3f}s"
+                              .format(time.perf_counter()-t0))
+            except Exception:
+                logging.exception("Error while saving state")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def start_flusher(interval=2):
+    if Flusher.current is None:
+        Flusher.current = Flusher(interval)
+
+def close():
+    global store
+    if Flusher.current is not None:
+        Flusher.current.stop()
+        Flusher.current = None
+    flush()
+    if store is not None:
+        store.close()
+        store = None
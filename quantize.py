@@ -1,68 +1,126 @@
 #!/usr/bin/env python3
 
-import shelve
-import sys
-
-# QUANTIZE will be the accuracy of quantization.
-# E.g. 24 = quant to the quarter note.
-# Magic value of 0 = do nothing.
-filename, QUANTIZE = sys.argv[1:]
-
-QUANTIZE = int(QUANTIZE)
-
-db = shelve.open(sys.argv[1])
-
-notes = db["notes"]
-
-
-def quantize(tick):
-    if QUANTIZE == 0:
-        return
-    offset = tick % QUANTIZE
-    if offset < QUANTIZE/2:
-        new_tick = tick-offset
-    else:
-        new_tick = tick-offset+QUANTIZE
-    if tick != new_tick:
-        print("Quantizing {} to {}".format(tick, new_tick))
-    return new_tick
-
-
-def move(src, dst):
-    print("{} -> {}".format(src, dst))
-    if dst not in notes:
-        notes[dst] = []
-    notes[dst].extend(notes[src])
-    del notes[src]
-
-
-ticks = sorted(notes.keys())
-for tick, next_tick in zip(ticks, ticks[1:]):
-    for note in notes[tick]:
-        bar = tick//24//4
-        beat = tick/24%4
-        print("{bar:3}.{beat:3} | {note.note:3} | {note.velocity:3} | {note.duration:3}"
-              .format(bar=bar, beat=beat, note=note))
-        note.duration = quantize(note.duration)
-        if note.duration == 0:
-            note.duration = quantize(next_tick - tick)
-
-for note in notes[ticks[-1]]:
-    if note.duration == 0 and QUANTIZE > 0:
-        note.duration = 24
-
-ticks = sorted(notes.keys())
-for src in ticks:
-    dst = quantize(src)
-    if src != dst:
-        move(src, dst)
-
-ticks = sorted(notes.keys())
-first = ticks[0]
-if first > 0 and QUANTIZE > 0:
-    for tick in ticks:
-        move(tick, tick-first)
-
-db["notes"] = notes
-
-db.close()
+import random
+
+from events import Events
+
+
+class Quantizer(object):
+    """Move notes towards a rhythmic grid.
+
+    - grid: size of the grid, in ticks (24 = quarter note, 12 = eighth
+      note...). 0 means "don't quantize".
+    - strength: how far notes are moved towards the grid (1.0 = all the
+      way, 0.5 = half way...).
+    - swing: how much every other grid position is delayed, as a
+      fraction of the grid (0 = straight, 0.33 = triplet feel).
+    - humanize: after quantizing, move notes by a random amount
+      between -humanize and +humanize ticks.
+    """
+
+    def __init__(self, grid=24, strength=1.0, swing=0.0, humanize=0,
+                 seed=None):
+        self.grid = grid
+        self.strength = strength
+        self.swing = swing
+        self.humanize = humanize
+        self.random = random.Random(seed)
+
+    def target(self, tick):
+        # Return the grid position closest to that tick
+        index, offset = divmod(tick, self.grid)
+        if 2*offset >= self.grid:
+            index += 1
+        target = index * self.grid
+        if index % 2:
+            target += round(self.swing * self.grid)
+        return target
+
+    def tick(self, tick):
+        if self.grid > 0:
+            tick += round((self.target(tick) - tick) * self.strength)
+        if self.humanize:
+            tick += self.random.randint(-self.humanize, self.humanize)
+        return max(0, tick)
+
+    def duration(self, duration):
+        # Round a duration to a multiple of the grid (no swing here)
+        if self.grid == 0:
+            return duration
+        target = (duration + self.grid//2) // self.grid * self.grid
+        return duration + round((target - duration) * self.strength)
+
+    def apply(self, events, start=0, end=0):
+        # Return a quantized copy of events (the original isn't changed).
+        # Ticks are computed all at once, then the columns are reordered
+        # in a single pass (notes ending up on the same tick keep their
+        # relative order).
+        # If `end` is set (e.g. to the end of a loop), notes moved to (or
+        # past) it wrap around to `start`, and conversely.
+        ticks = [self.tick(tick) for tick in events.ticks]
+        if end > 0:
+            length = end - start
+            for i, tick in enumerate(events.ticks):
+                if tick < end <= ticks[i]:
+                    ticks[i] -= length
+                elif ticks[i] < start <= tick:
+                    ticks[i] += length
+        order = sorted(range(len(ticks)), key=ticks.__getitem__)
+        result = Events()
+        result.ticks.extend(ticks[i] for i in order)
+        result.notes.extend(events.notes[i] for i in order)
+        result.velocities.extend(events.velocities[i] for i in order)
+        result.durations.extend(events.durations[i] for i in order)
+        if self.grid > 0:
+            # Notes are now on the grid, not in between ticks
+            result.offsets.extend(bytes(len(order)))
+        else:
+            result.offsets.extend(events.offsets[i] for i in order)
+        return result
+
+
+if __name__ == "__main__":
+    import bisect
+    import pickle
+    import sys
+
+    import persistence
+    from looper import upgrade_notes
+
+    # QUANTIZE will be the accuracy of quantization.
+    # E.g. 24 = quant to the quarter note.
+    # Magic value of 0 = do nothing.
+    filename, QUANTIZE = sys.argv[1:]
+
+    QUANTIZE = int(QUANTIZE)
+    quantizer = Quantizer(QUANTIZE)
+
+    # The filename is the key of the loop in the state store,
+    # e.g. "state/Loop__1,1.sav".
+    store = persistence.get_store()
+    events = upgrade_notes(pickle.loads(store.load(filename)["notes"]))
+
+    if QUANTIZE > 0 and events:
+        # Quantize durations. Notes that end up with no duration get
+        # one that lasts until the next note (or a quarter note for
+        # the last ones).
+        ticks = events.ticks
+        for i, tick in enumerate(ticks):
+            duration = quantizer.duration(events.durations[i])
+            if duration == 0:
+                j = bisect.bisect_right(ticks, tick)
+                if j < len(ticks):
+                    duration = quantizer.duration(ticks[j] - tick)
+                else:
+                    duration = 24
+            events.durations[i] = duration
+        events = quantizer.apply(events)
+        # Make the loop start on its first note
+        first = events.ticks[0]
+        for i in range(len(events.ticks)):
+            events.ticks[i] -= first
+        print("Quantized {} notes".format(len(events)))
+
+    store.save([(filename, "notes", pickle.dumps(events))])
+
+    persistence.close()
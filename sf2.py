@@ -0,0 +1,62 @@
+import mmap
+import struct
+
+# A minimal SoundFont 2 reader: it only reads the preset headers (i.e. the
+# list of instruments). The file is memory-mapped, and we jump from chunk
+# header to chunk header; so the sample data (which is most of the file)
+# is never read.
+#
+# The file is a RIFF file:
+#   RIFF <size> sfbk
+#     LIST <size> INFO ...
+#     LIST <size> sdta ... (samples)
+#     LIST <size> pdta
+#       phdr <size> (preset headers, 38 bytes each)
+#       pbag, pmod, pgen, inst, ibag... (we don't need these)
+#
+# Each preset header is:
+#   name (20 bytes), preset (uint16), bank (uint16), bag index (uint16),
+#   library, genre, morphology (uint32 each)
+# The last preset header is a terminator ("EOP").
+
+PHDR = struct.Struct("<20sHHHIII")
+
+
+def chunks(data, start, end):
+    # Yield (chunk id, offset of chunk data, size of chunk data)
+    offset = start
+    while offset + 8 <= end:
+        chunk_id, size = struct.unpack_from("<4sI", data, offset)
+        yield chunk_id, offset+8, size
+        # Chunks are padded to an even size
+        offset += 8 + size + (size & 1)
+
+
+def presets(path):
+    # Return the list of (bank, program, name) of a soundfont.
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            riff, size, form = struct.unpack_from("<4sI4s", data, 0)
+            if riff != b"RIFF" or form != b"sfbk":
+                raise ValueError("{} is not a SoundFont 2 file".format(path))
+            end = min(len(data), 8 + size)
+            for chunk_id, offset, size in chunks(data, 12, end):
+                if chunk_id != b"LIST" or data[offset:offset+4] != b"pdta":
+                    continue
+                for sub_id, sub_offset, sub_size in chunks(
+                        data, offset+4, offset+size):
+                    if sub_id == b"phdr":
+                        return read_phdr(data, sub_offset, sub_size)
+    raise ValueError("No preset headers found in {}".format(path))
+
+
+def read_phdr(data, offset, size):
+    result = []
+    count = size // PHDR.size
+    # Skip the last record (the "EOP" terminator)
+    for i in range(count - 1):
+        name, program, bank, _, _, _, _ = PHDR.unpack_from(
+            data, offset + i*PHDR.size)
+        name = name.split(b"\0", 1)[0].decode("latin-1")
+        result.append((bank, program, name))
+    return result